@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : asynclog.py
+Desсription : Фоновая буферизованная запись логов через очередь
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import os
+import time
+import queue
+import threading
+import logging
+import logging.handlers
+
+#---------------------------------
+# обработчик, который никогда не блокирует вызывающий поток
+#---------------------------------
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, queue):
+        """Кладет записи в очередь; при переполненной очереди запись теряется"""
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # очередь не покидает процесс, поэтому запись не нужно
+        # форматировать заранее - это сделает фоновый поток
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+#---------------------------------
+# запись в файл пачками
+#---------------------------------
+class BufferedFileHandler(logging.Handler):
+
+    def __init__(self, filename=None, fd=None, buffer_size=65536):
+        """Копит строки в памяти и пишет их одним os.write.
+
+        Файл открывается в режиме O_APPEND, а в файл попадают только
+        целые строки, поэтому несколько процессов могут писать
+        в один файл, не перемешивая строки
+        """
+        super().__init__()
+        if filename is not None:
+            self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.own_fd = True
+        else:
+            self.fd = fd if fd is not None else 2
+            self.own_fd = False
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        self.buffer.append(line)
+        self.size += len(line)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self.buffer:
+                return
+            data = memoryview("".join(self.buffer).encode("utf-8", "replace"))
+            self.buffer = []
+            self.size = 0
+            while data:
+                try:
+                    data = data[os.write(self.fd, data):]
+                except InterruptedError:
+                    continue
+                except OSError:
+                    break # писать некуда - строки теряются
+        finally:
+            self.release()
+
+    def reset(self):
+        # после fork буфер принадлежит родителю - он его и запишет
+        self.buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.own_fd:
+            os.close(self.fd)
+            self.own_fd = False
+        super().close()
+
+#---------------------------------
+# поток, разбирающий очередь
+#---------------------------------
+class LogWriter(threading.Thread):
+
+    def __init__(self, queue, handlers, flush_interval=1.0):
+        """Передает записи обработчикам и сбрасывает их буферы
+        не реже раза в flush_interval секунд"""
+        super().__init__(name="LogWriter", daemon=True)
+        self.queue = queue
+        self.handlers = handlers
+        self.flush_interval = flush_interval
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = now
+        self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+#---------------------------------
+# очередь, обработчик и поток записи вместе
+#---------------------------------
+class AsyncLog:
+
+    def __init__(self, handlers, queue_size=10000, flush_interval=1.0):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.writer = None
+
+    def start(self):
+        self.writer = LogWriter(self.queue, self.handlers, self.flush_interval)
+        self.writer.start()
+
+    def stop(self):
+        if self.writer is None:
+            return
+        # маркер остановки ждет места в очереди, остальные записи уже в ней
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def after_fork(self):
+        # в дочернем процессе потока записи нет: начинаем с новой очередью
+        self.queue = queue.Queue(self.queue_size)
+        self.handler.queue = self.queue
+        for handler in self.handlers:
+            if hasattr(handler, "reset"):
+                handler.reset()
+        self.start()
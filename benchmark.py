@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : benchmark.py
+Desсription : Нагрузочное тестирование сокет сервера
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+
+Запуск: python benchmark.py --engine threads --clients 50 --duration 5
+Сервер поднимается в дочернем процессе на свободном локальном порту
+поверх сгенерированного дерева файлов, после чего каждый сценарий
+прогоняется клиентами с постоянными соединениями и без них.
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import os,sys
+import time
+import socket
+import shutil
+import tempfile
+import argparse
+import threading
+import http.client
+import multiprocessing
+
+import socket_server
+
+#---------------------------------
+# настройки по умолчанию
+#---------------------------------
+CLIENTS = 20
+DURATION = 5.0
+WIDE_DIR_ENTRIES = 100000
+DEEP_DIR_LEVELS = 32
+HUGE_FILE_SIZE = 64*1024*1024
+SMALL_FILES = 100
+START_TIMEOUT = 10.0
+
+#---------------------------------
+# генерация тестового дерева файлов
+#---------------------------------
+def make_fixtures(root, wide=WIDE_DIR_ENTRIES, depth=DEEP_DIR_LEVELS,
+                  huge_size=HUGE_FILE_SIZE):
+    # глубокая вложенность каталогов
+    path = os.path.join(root, "deep")
+    for level in range(depth):
+        path = os.path.join(path, "level%02d" % level)
+    os.makedirs(path)
+    with open(os.path.join(path, "leaf.txt"), "w") as f:
+        f.write("leaf\n")
+
+    # каталог с огромным числом записей
+    wide_dir = os.path.join(root, "wide")
+    os.makedirs(wide_dir)
+    for i in range(wide):
+        open(os.path.join(wide_dir, "file%06d.txt" % i), "wb").close()
+
+    # небольшой каталог для листинга
+    small_dir = os.path.join(root, "small")
+    os.makedirs(small_dir)
+    for i in range(SMALL_FILES):
+        with open(os.path.join(small_dir, "file%03d.txt" % i), "w") as f:
+            f.write("small file %d\n" % i * 16)
+
+    # большой файл - пишем блоками, чтобы не держать его в памяти
+    block = os.urandom(1024*1024)
+    with open(os.path.join(root, "huge.bin"), "wb") as f:
+        for _ in range(huge_size // len(block)):
+            f.write(block)
+        f.write(block[:huge_size % len(block)])
+
+    # тексты в разных кодировках
+    text = "Съешь же ещё этих мягких французских булок, да выпей чаю.\n" * 200
+    for encoding in ("utf-8", "cp1251", "koi8-r", "utf-16"):
+        with open(os.path.join(root, "text-%s.txt" % encoding), "wb") as f:
+            f.write(text.encode(encoding))
+    with open(os.path.join(root, "ascii.txt"), "w") as f:
+        f.write("The quick brown fox jumps over the lazy dog.\n" * 200)
+
+#---------------------------------
+# сценарии нагрузки: имя -> (путь, заголовки запроса)
+#---------------------------------
+def make_scenarios(etag_value):
+    return [
+        ("listing",      "/small/",           {}),
+        ("listing-wide", "/wide/?limit=100",  {}),
+        ("304",          "/ascii.txt",        {"If-None-Match": etag_value}),
+        ("full-small",   "/text-cp1251.txt",  {}),
+        ("full-huge",    "/huge.bin",         {}),
+        ("range",        "/huge.bin",         {"Range": "bytes=1048576-1114111"}),
+        ("deep",         "/deep/" + "/".join("level%02d" % i
+                            for i in range(DEEP_DIR_LEVELS)) + "/leaf.txt", {}),
+        ("404",          "/no/such/file",     {}),
+    ]
+
+#---------------------------------
+# сервер в дочернем процессе
+#---------------------------------
+def free_port(host):
+    # порт выбирает ядро; между закрытием и повторным bind его
+    # теоретически может занять кто-то другой, для бенчмарка это допустимо
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def run_server(host, port, root, engine):
+    # отладочный вывод сервера не должен смешиваться с отчетом
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    socket_server.ROOT = root
+    socket_server.ENGINE = engine
+    socket_server.HOST = "{}:{}".format(host, port)
+    # всплеск соединений не должен упираться в очередь listen
+    socket_server.DEPTH_QUEUE_CONNECTIONS = 1024
+    # журнал запросов ведется, как в обычной работе, но уходит в никуда
+    socket_server.setup_logging()
+    try:
+        socket_server.run_engine(host, port, socket_server.DEFAULT_CHARSET)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket_server.stop_logging()
+
+def start_server(host, root, engine):
+    port = free_port(host)
+    process = multiprocessing.Process(target=run_server,
+                                      args=(host, port, root, engine),
+                                      daemon=True)
+    process.start()
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("server did not start on port %s" % port)
+
+def stop_server(process):
+    process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+
+#---------------------------------
+# потребление ресурсов процессом сервера
+#---------------------------------
+def process_cpu(pid):
+    # utime + stime в секундах, None - если /proc недоступен
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def process_rss(pid):
+    # (текущий, пиковый) размер резидентной памяти в байтах
+    rss = peak = None
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss, peak
+
+#---------------------------------
+# клиенты
+#---------------------------------
+class Client(threading.Thread):
+
+    def __init__(self, host, port, path, headers, keep_alive, stop_at):
+        """Шлет один и тот же запрос до stop_at и копит задержки"""
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.headers = dict(headers)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+        self.keep_alive = keep_alive
+        self.stop_at = stop_at
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    def run(self):
+        conn = None
+        while time.monotonic() < self.stop_at:
+            if conn is None:
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            start = time.perf_counter()
+            try:
+                conn.request("GET", self.path, headers=self.headers)
+                response = conn.getresponse()
+                while True:
+                    data = response.read(1024*1024)
+                    if not data:
+                        break
+                    self.bytes += len(data)
+                self.latencies.append(time.perf_counter() - start)
+                if not self.keep_alive or response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+def percentile(values, p):
+    # values должны быть отсортированы
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def run_scenario(host, port, pid, path, headers, keep_alive, clients, duration):
+    stop_at = time.monotonic() + duration
+    workers = [Client(host, port, path, headers, keep_alive, stop_at)
+                    for _ in range(clients)]
+    cpu_before = process_cpu(pid)
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    cpu_after = process_cpu(pid)
+
+    latencies = sorted(l for worker in workers for l in worker.latencies)
+    rss, peak = process_rss(pid)
+    return {
+        "requests": len(latencies),
+        "errors": sum(worker.errors for worker in workers),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mbps": sum(worker.bytes for worker in workers) / elapsed / 1024 / 1024,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "cpu": (cpu_after - cpu_before) if cpu_before is not None and cpu_after is not None else None,
+        "rss": rss,
+        "peak_rss": peak,
+    }
+
+#---------------------------------
+# отчет
+#---------------------------------
+REPORT_HEADER = "{:<14} {:<5} {:>8} {:>6} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+    "scenario", "conn", "requests", "errors", "req/s", "MiB/s",
+    "p50 ms", "p95 ms", "p99 ms", "cpu s", "rss MiB")
+
+def format_row(name, mode, result):
+    cpu = "%.2f" % result["cpu"] if result["cpu"] is not None else "n/a"
+    rss = "%.1f" % (result["rss"] / 1024 / 1024) if result["rss"] is not None else "n/a"
+    return "{:<14} {:<5} {:>8} {:>6} {:>10.1f} {:>8.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8} {:>8}".format(
+        name, mode, result["requests"], result["errors"], result["rps"], result["mbps"],
+        result["p50"] * 1000, result["p95"] * 1000, result["p99"] * 1000, cpu, rss)
+
+def fetch_etag(host, port, path):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.getheader("ETag", "")
+    finally:
+        conn.close()
+
+#---------------------------------
+# запуск
+#---------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование сокет сервера")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес сервера")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="движок сервера")
+    parser.add_argument("--clients", type=int, default=CLIENTS,
+                        help="число одновременных клиентов")
+    parser.add_argument("--duration", type=float, default=DURATION,
+                        help="длительность каждого сценария, секунд")
+    parser.add_argument("--scenario", action="append",
+                        help="запускать только указанные сценарии")
+    parser.add_argument("--mode", choices=("keepalive", "close", "both"), default="both",
+                        help="постоянные соединения, новое соединение на запрос или оба")
+    parser.add_argument("--root", help="готовое дерево файлов (по умолчанию генерируется)")
+    parser.add_argument("--wide", type=int, default=WIDE_DIR_ENTRIES,
+                        help="число записей в большом каталоге")
+    parser.add_argument("--huge-size", type=int, default=HUGE_FILE_SIZE,
+                        help="размер большого файла, байт")
+    args = parser.parse_args(argv)
+
+    root = args.root
+    tmpdir = None
+    if root is None:
+        tmpdir = tempfile.mkdtemp(prefix="socket_server_bench_")
+        root = tmpdir
+        print("generating fixtures in %s ..." % root)
+        make_fixtures(root, wide=args.wide, huge_size=args.huge_size)
+
+    modes = {"keepalive": [True], "close": [False], "both": [True, False]}[args.mode]
+    process = None
+    try:
+        process, port = start_server(args.host, root, args.engine)
+        print("engine=%s port=%s clients=%s duration=%ss" % (
+            args.engine, port, args.clients, args.duration))
+        print(REPORT_HEADER)
+
+        etag_value = fetch_etag(args.host, port, "/ascii.txt")
+        for name, path, headers in make_scenarios(etag_value):
+            if args.scenario and name not in args.scenario:
+                continue
+            for keep_alive in modes:
+                result = run_scenario(args.host, port, process.pid, path, headers,
+                                      keep_alive, args.clients, args.duration)
+                print(format_row(name, "ka" if keep_alive else "close", result))
+                sys.stdout.flush()
+
+        rss, peak = process_rss(process.pid)
+        if peak is not None:
+            print("server peak rss: %.1f MiB" % (peak / 1024 / 1024))
+    finally:
+        if process is not None:
+            stop_server(process)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : fswatch.py
+Desсription : Наблюдение за изменениями в каталогах (inotify или опрос)
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import os
+import sys
+import time
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+#---------------------------------
+# константы inotify (linux/inotify.h)
+#---------------------------------
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = getattr(os, "O_CLOEXEC", 0o2000000)
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+
+#---------------------------------
+# общая часть наблюдателей
+#---------------------------------
+class Watcher:
+
+    def __init__(self, callback, max_watches=8192):
+        """callback(dirpath, name) вызывается из фонового потока:
+        name - имя измененной записи каталога, None - изменился (исчез) сам
+        каталог; callback(None, None) - изменения могли быть потеряны,
+        сбросить нужно все.
+
+        Каждому наблюдаемому каталогу соответствует поколение, которое
+        растет при любом изменении в нем: закэшированное при поколении N
+        можно использовать без обращения к диску, пока поколение равно N
+        """
+        self.callback = callback
+        self.max_watches = max_watches
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def generation(self, dirpath):
+        # None - каталог не наблюдается, доверять кэшу нельзя
+        return self.generations.get(dirpath)
+
+    def watch(self, dirpath):
+        raise NotImplementedError
+
+    def changed(self, dirpath, name):
+        with self.lock:
+            if dirpath in self.generations:
+                self.generations[dirpath] += 1
+        self.callback(dirpath, name)
+
+    def forget(self, dirpath):
+        with self.lock:
+            self.generations.pop(dirpath, None)
+        self.callback(dirpath, None)
+
+    def overflow(self):
+        # события потеряны: сдвигаем все поколения и сбрасываем кэши
+        with self.lock:
+            for dirpath in self.generations:
+                self.generations[dirpath] += 1
+        self.callback(None, None)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        raise NotImplementedError
+
+#---------------------------------
+# inotify через ctypes (Linux)
+#---------------------------------
+class InotifyWatcher(Watcher):
+
+    def __init__(self, callback, max_watches=8192):
+        super().__init__(callback, max_watches)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {} # wd -> каталог
+
+    def watch(self, dirpath):
+        with self.lock:
+            if dirpath in self.generations:
+                return True
+            if len(self.paths) >= self.max_watches:
+                return False
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                # ENOENT, ENOTDIR, ENOSPC (исчерпан лимит ядра) - просто не наблюдаем
+                return False
+            self.paths[wd] = dirpath
+            self.generations[dirpath] = 0
+            return True
+
+    def run(self):
+        while self.running:
+            try:
+                ready,_,_ = select.select([self.fd], [], [], 1.0)
+            except InterruptedError:
+                continue
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                continue
+            self.dispatch(data)
+        os.close(self.fd)
+
+    def dispatch(self, data):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflow()
+                continue
+            dirpath = self.paths.get(wd)
+            if dirpath is None:
+                continue
+            if mask & IN_IGNORED:
+                # наблюдение снято ядром (каталог удален или размонтирован)
+                with self.lock:
+                    self.paths.pop(wd, None)
+                self.forget(dirpath)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # перемещенный каталог живет по другому пути - прежний путь
+                # больше не наблюдается
+                with self.lock:
+                    self.paths.pop(wd, None)
+                    self._rm_watch(self.fd, wd)
+                self.forget(dirpath)
+            elif name:
+                self.changed(dirpath, os.fsdecode(name))
+            else:
+                self.changed(dirpath, None)
+
+#---------------------------------
+# опрос каталогов (все остальные системы)
+#---------------------------------
+class PollingWatcher(Watcher):
+
+    def __init__(self, callback, max_watches=8192, interval=2.0):
+        super().__init__(callback, max_watches)
+        self.interval = interval
+        self.snapshots = {} # каталог -> {имя: (mtime_ns, размер, inode)}
+
+    @staticmethod
+    def snapshot(dirpath):
+        result = {}
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                result[entry.name] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        return result
+
+    def watch(self, dirpath):
+        with self.lock:
+            if dirpath in self.generations:
+                return True
+            if len(self.snapshots) >= self.max_watches:
+                return False
+        try:
+            snapshot = self.snapshot(dirpath)
+        except OSError:
+            return False
+        with self.lock:
+            if dirpath not in self.generations:
+                self.snapshots[dirpath] = snapshot
+                self.generations[dirpath] = 0
+        return True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            with self.lock:
+                dirs = list(self.snapshots)
+            for dirpath in dirs:
+                self.poll(dirpath)
+
+    def poll(self, dirpath):
+        old = self.snapshots.get(dirpath)
+        if old is None:
+            return
+        try:
+            new = self.snapshot(dirpath)
+        except OSError:
+            with self.lock:
+                self.snapshots.pop(dirpath, None)
+            self.forget(dirpath)
+            return
+        self.snapshots[dirpath] = new
+        for name in old.keys() | new.keys():
+            if old.get(name) != new.get(name):
+                self.changed(dirpath, name)
+
+#---------------------------------
+# выбор наблюдателя
+#---------------------------------
+def create_watcher(callback, kind="auto", max_watches=8192, interval=2.0):
+    # kind: auto, inotify, poll; None - наблюдение недоступно.
+    # auto - только inotify: опрос отдает закэшированное без stat
+    # до interval секунд и сам перечитывает все каталоги, поэтому
+    # включается лишь явным kind="poll"
+    if kind in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(callback, max_watches)
+        except (OSError, AttributeError):
+            if kind == "inotify":
+                raise
+    if kind == "poll":
+        return PollingWatcher(callback, max_watches, interval)
+    return None
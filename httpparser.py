@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : httpparser.py
+Desсription : Инкрементальный разбор HTTP запросов и чтение тела запроса
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import re
+
+#---------------------------------
+# ошибка в запросе: ответ с кодом status и закрытие соединения
+#---------------------------------
+class HTTPError(Exception):
+
+    def __init__(self, status, message=""):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message or status
+
+BAD_REQUEST = "400 Bad Request"
+PAYLOAD_TOO_LARGE = "413 Payload Too Large"
+URI_TOO_LONG = "414 URI Too Long"
+HEADERS_TOO_LARGE = "431 Request Header Fields Too Large"
+NOT_IMPLEMENTED = "501 Not Implemented"
+VERSION_NOT_SUPPORTED = "505 HTTP Version Not Supported"
+
+# token из RFC 7230: имя метода и имя заголовка
+TOKEN = re.compile(rb"[!#$%&'*+\-.^_`|~0-9A-Za-z]+\Z")
+VERSION = re.compile(rb"HTTP/(\d)\.(\d)\Z")
+# размер части chunked тела - только шестнадцатеричные цифры: int(x, 16)
+# принял бы и 0x5, +5, 0_5, а разное прочтение длины - это smuggling
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}\Z")
+
+#---------------------------------
+# стартовая строка и заголовки запроса
+#---------------------------------
+class RequestHead:
+    __slots__ = ("method", "target", "version", "headers",
+                 "content_length", "chunked")
+
+    def __init__(self, method, target, version, headers, content_length, chunked):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers # список (имя, значение), имена в виде Content-Length
+        self.content_length = content_length # None - тела нет или оно chunked
+        self.chunked = chunked
+
+    @property
+    def has_body(self):
+        return self.chunked or bool(self.content_length)
+
+class RequestParser:
+
+    def __init__(self, max_header_size=65536, max_headers=100,
+                 max_request_line=8192, max_body_size=None):
+        """Разбирает заголовки запроса построчно по мере поступления байт.
+
+        Уже разобранные строки повторно не просматриваются, а лимиты
+        проверяются до того, как придет весь заголовок
+        """
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_request_line = max_request_line
+        self.max_body_size = max_body_size
+        self.reset()
+
+    def reset(self):
+        self.pos = 0            # до этой позиции буфер уже разобран
+        self.request_line = None
+        self.headers = []
+
+    def parse(self, buffer):
+        # buffer - bytearray соединения. Возвращает RequestHead, когда
+        # заголовки получены полностью (их байты удаляются из буфера),
+        # None - если нужно ждать еще данных; при ошибке - HTTPError
+        while True:
+            # строки заканчиваются CRLF, но голый LF тоже допускается (RFC 7230, 3.5)
+            end = buffer.find(b"\n", self.pos)
+            if end == -1:
+                self.check_incomplete(buffer)
+                return None
+            line = bytes(memoryview(buffer)[self.pos:end]).rstrip(b"\r")
+            self.pos = end + 1
+
+            if self.request_line is None:
+                # пустые строки перед запросом допускаются и игнорируются
+                if not line:
+                    del buffer[:self.pos]
+                    self.pos = 0
+                    continue
+                if len(line) > self.max_request_line:
+                    raise HTTPError(URI_TOO_LONG)
+                self.request_line = self.parse_request_line(line)
+                continue
+
+            if not line:
+                head = self.finish()
+                del buffer[:self.pos]
+                self.reset()
+                return head
+
+            if self.pos > self.max_header_size:
+                raise HTTPError(HEADERS_TOO_LARGE)
+            if len(self.headers) >= self.max_headers:
+                raise HTTPError(HEADERS_TOO_LARGE, "Too many header fields")
+            self.headers.append(self.parse_header(line))
+
+    def check_incomplete(self, buffer):
+        # строка еще не закончилась - не даем ей расти без предела
+        if self.request_line is None:
+            if len(buffer) - self.pos > self.max_request_line:
+                raise HTTPError(URI_TOO_LONG)
+        elif len(buffer) > self.max_header_size:
+            raise HTTPError(HEADERS_TOO_LARGE)
+
+    @staticmethod
+    def parse_request_line(line):
+        parts = line.split(b" ")
+        if len(parts) != 3 or not TOKEN.match(parts[0]) or not parts[1]:
+            raise HTTPError(BAD_REQUEST, "Malformed request line")
+        version = VERSION.match(parts[2])
+        if version is None:
+            raise HTTPError(BAD_REQUEST, "Malformed HTTP version")
+        if version.group(1) != b"1":
+            raise HTTPError(VERSION_NOT_SUPPORTED)
+        try:
+            target = parts[1].decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPError(BAD_REQUEST, "Malformed request target")
+        return parts[0].decode("ascii"), target, parts[2].decode("ascii")
+
+    @staticmethod
+    def parse_header(line):
+        name, colon, value = line.partition(b":")
+        # пробел перед двоеточием и продолжение на следующей строке
+        # (obs-fold) запрещены - это классические приемы request smuggling
+        if not colon or not TOKEN.match(name):
+            raise HTTPError(BAD_REQUEST, "Malformed header field")
+        # значения заголовков - latin-1, как велит RFC 7230
+        return name.decode("ascii").title(), value.strip(b" \t").decode("latin-1")
+
+    def finish(self):
+        method, target, version = self.request_line
+        headers = self.headers
+
+        content_length = None
+        chunked = False
+        lengths = set()
+        transfer_encoding = None
+        for name, value in headers:
+            if name == "Content-Length":
+                lengths.add(value)
+            elif name == "Transfer-Encoding":
+                transfer_encoding = (transfer_encoding + "," + value
+                                     if transfer_encoding else value)
+
+        if transfer_encoding is not None:
+            # Content-Length вместе с Transfer-Encoding - признак smuggling
+            if lengths:
+                raise HTTPError(BAD_REQUEST, "Both Content-Length and Transfer-Encoding")
+            codings = [c.strip().lower() for c in transfer_encoding.split(",")]
+            if codings != ["chunked"]:
+                raise HTTPError(NOT_IMPLEMENTED, "Unsupported transfer coding")
+            chunked = True
+        elif lengths:
+            if len(lengths) > 1:
+                raise HTTPError(BAD_REQUEST, "Conflicting Content-Length")
+            value = lengths.pop()
+            if not value.isdigit():
+                raise HTTPError(BAD_REQUEST, "Malformed Content-Length")
+            content_length = int(value)
+            if self.max_body_size is not None and content_length > self.max_body_size:
+                raise HTTPError(PAYLOAD_TOO_LARGE)
+
+        return RequestHead(method, target, version, headers, content_length, chunked)
+
+#---------------------------------
+# тело запроса потоком
+#---------------------------------
+class BodyReader:
+
+    def __init__(self, buffer, recv, head, max_body_size=None,
+                 recv_size=65536, max_line=4096):
+        """Читает тело запроса по Content-Length или chunked.
+
+        Сначала берутся байты, уже лежащие в буфере соединения, потом -
+        recv(recv_size) из сокета. Все, что идет после тела (следующие
+        конвейерные запросы), остается в буфере
+        """
+        self.buffer = buffer
+        self.recv = recv
+        self.chunked = head.chunked
+        self.remaining = head.content_length or 0 # до конца тела или части
+        self.max_body_size = max_body_size
+        self.recv_size = recv_size
+        self.max_line = max_line
+        self.received = 0
+        self.end_of_chunk = False
+        self.done = not head.has_body
+
+    def fill(self):
+        data = self.recv(self.recv_size)
+        if not data:
+            raise HTTPError(BAD_REQUEST, "Connection closed before end of body")
+        self.buffer += data
+
+    def read_line(self):
+        while True:
+            end = self.buffer.find(b"\r\n")
+            if end != -1:
+                line = bytes(self.buffer[:end])
+                del self.buffer[:end + 2]
+                return line
+            if len(self.buffer) > self.max_line:
+                raise HTTPError(BAD_REQUEST, "Chunk line too long")
+            self.fill()
+
+    def next_chunk(self):
+        # размер очередной части chunked тела; 0 - тело закончилось
+        line = self.read_line()
+        size = line.split(b";", 1)[0].rstrip(b" \t")
+        if not CHUNK_SIZE.match(size):
+            raise HTTPError(BAD_REQUEST, "Malformed chunk size")
+        size = int(size, 16)
+        if size == 0:
+            # трейлеры не используем, но дочитываем до пустой строки
+            while self.read_line():
+                pass
+        return size
+
+    def read(self, size=-1):
+        # не больше size байт тела; b"" - тело прочитано полностью
+        while not self.done:
+            if not self.remaining:
+                if not self.chunked:
+                    self.done = True
+                    break
+                if self.end_of_chunk:
+                    # после данных каждой части идет CRLF
+                    if self.read_line():
+                        raise HTTPError(BAD_REQUEST, "Malformed chunk")
+                    self.end_of_chunk = False
+                self.remaining = self.next_chunk()
+                if not self.remaining:
+                    self.done = True
+                    break
+                continue
+            
+            if not self.buffer:
+                self.fill()
+            n = min(self.remaining, len(self.buffer))
+            if size is not None and size >= 0:
+                n = min(n, size)
+            data = bytes(self.buffer[:n])
+            del self.buffer[:n]
+            self.remaining -= n
+            self.received += n
+            if self.max_body_size is not None and self.received > self.max_body_size:
+                raise HTTPError(PAYLOAD_TOO_LARGE)
+            self.end_of_chunk = self.chunked and not self.remaining
+            return data
+        return b""
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.recv_size), b"")
+
+    def discard(self, limit):
+        # дочитывает и отбрасывает тело, если оно не больше limit байт;
+        # False - тело слишком большое, соединение лучше закрыть
+        total = 0
+        while not self.done:
+            data = self.read(limit - total + 1)
+            total += len(data)
+            if total > limit:
+                return False
+        return True
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : metrics.py
+Desсription : Счетчики и гистограммы в формате Prometheus
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import threading
+from bisect import bisect_left
+
+#---------------------------------
+# границы корзин гистограмм времени, секунды
+#---------------------------------
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                      .replace('"', '\\"'))
+                          for name, value in zip(names, values)) + "}"
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+#---------------------------------
+# счетчик
+#---------------------------------
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        """Монотонно растущее значение; labels - имена меток"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, key=(), value=1):
+        # key - кортеж значений меток
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def collect(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s counter" % self.name
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield "%s%s %s" % (self.name, format_labels(self.labels, key),
+                               format_value(value))
+
+#---------------------------------
+# значение, вычисляемое при выгрузке
+#---------------------------------
+class Gauge:
+
+    def __init__(self, name, help, func, labels=(), typ="gauge"):
+        """func() возвращает число или словарь {значения меток: число}"""
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = labels
+        self.typ = typ
+
+    def collect(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s %s" % (self.name, self.typ)
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield "%s%s %s" % (self.name, format_labels(self.labels, key),
+                               format_value(value))
+
+#---------------------------------
+# гистограмма
+#---------------------------------
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        """Распределение значений по корзинам с накопленными суммами"""
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # значения меток -> [счетчики корзин (+Inf последней), сумма]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, key=()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                item = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][index] += 1
+            item[1] += value
+
+    def collect(self):
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s histogram" % self.name
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                                for key, (counts, total) in self.values.items())
+        names = self.labels + ("le",)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield "%s_bucket%s %s" % (self.name,
+                                          format_labels(names, key + (bound,)),
+                                          cumulative)
+            labels = format_labels(self.labels, key)
+            yield "%s_sum%s %s" % (self.name, labels, repr(total))
+            yield "%s_count%s %s" % (self.name, labels, cumulative)
+
+#---------------------------------
+# набор метрик
+#---------------------------------
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # текстовый формат Prometheus (version 0.0.4)
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
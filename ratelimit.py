@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : ratelimit.py
+Desсription : Ограничение соединений, запросов и трафика на клиента
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import time
+import threading
+
+#---------------------------------
+# состояние одного клиента
+#---------------------------------
+class ClientState:
+    __slots__ = ("connections", "requests", "bandwidth", "updated")
+
+    def __init__(self, requests, bandwidth, now):
+        self.connections = 0
+        # ведра маркеров: запросы и байты, уходящие в минус при долге
+        self.requests = requests
+        self.bandwidth = bandwidth
+        self.updated = now
+
+#---------------------------------
+# лимиты по адресу клиента
+#---------------------------------
+class ClientLimiter:
+
+    def __init__(self, max_connections=0, request_rate=0, request_burst=None,
+                 bandwidth=0, bandwidth_burst=None, shards=64, sweep_interval=60):
+        """Ограничивает каждый адрес числом одновременных соединений
+        и двумя ведрами маркеров: запросов в секунду и байт в секунду.
+        Нулевой лимит - без ограничения.
+
+        Адреса разложены по shards независимым словарям со своими
+        блокировками, поэтому потоки, обслуживающие разных клиентов,
+        почти никогда не ждут друг друга. Записи о клиентах без
+        соединений и с полными ведрами удаляются не чаще раза
+        в sweep_interval секунд на словарь
+        """
+        self.max_connections = max_connections
+        self.request_rate = request_rate
+        self.request_burst = request_burst or max(1, request_rate)
+        self.bandwidth_rate = bandwidth
+        self.bandwidth_burst = bandwidth_burst or bandwidth
+        self.sweep_interval = sweep_interval
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.swept = [time.monotonic()] * shards
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def state(self, clients, key, now):
+        # вызывается под блокировкой словаря clients
+        state = clients.get(key)
+        if state is None:
+            state = clients[key] = ClientState(self.request_burst,
+                                               self.bandwidth_burst, now)
+            return state
+        elapsed = now - state.updated
+        if elapsed > 0:
+            state.updated = now
+            if self.request_rate:
+                state.requests = min(self.request_burst,
+                                     state.requests + elapsed * self.request_rate)
+            if self.bandwidth_rate:
+                state.bandwidth = min(self.bandwidth_burst,
+                                      state.bandwidth + elapsed * self.bandwidth_rate)
+        return state
+
+    def connect(self, key):
+        # False - у клиента уже max_connections соединений
+        now = time.monotonic()
+        index = hash(key) % len(self.shards)
+        clients, lock = self.shards[index]
+        with lock:
+            if now - self.swept[index] >= self.sweep_interval:
+                self.swept[index] = now
+                self.sweep(clients, now)
+            state = self.state(clients, key, now)
+            if self.max_connections and state.connections >= self.max_connections:
+                return False
+            state.connections += 1
+            return True
+
+    def disconnect(self, key):
+        clients, lock = self.shard(key)
+        with lock:
+            state = clients.get(key)
+            if state is not None and state.connections > 0:
+                state.connections -= 1
+
+    def admit(self, key):
+        # очередной запрос клиента: 0 - можно обслуживать,
+        # иначе - через сколько секунд клиенту стоит повторить
+        now = time.monotonic()
+        clients, lock = self.shard(key)
+        with lock:
+            state = self.state(clients, key, now)
+            # за прошлые ответы клиент еще не расплатился трафиком
+            if self.bandwidth_rate and state.bandwidth < 0:
+                return -state.bandwidth / self.bandwidth_rate
+            if self.request_rate:
+                if state.requests < 1:
+                    return (1 - state.requests) / self.request_rate
+                state.requests -= 1
+            return 0
+
+    def sent(self, key, size):
+        # списывает отданные клиенту байты; ведро может уйти в минус -
+        # тогда следующие запросы ждут, пока долг не погасится
+        if not self.bandwidth_rate or not size:
+            return
+        now = time.monotonic()
+        clients, lock = self.shard(key)
+        with lock:
+            self.state(clients, key, now).bandwidth -= size
+
+    def sweep(self, clients, now):
+        for key in [k for k, s in clients.items() if not s.connections]:
+            state = self.state(clients, key, now)
+            if (state.requests >= self.request_burst and
+                    state.bandwidth >= self.bandwidth_burst):
+                del clients[key]
+
+    def __len__(self):
+        return sum(len(clients) for clients, _ in self.shards)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+#--------------------------------------
+"""
+Script      : snapshot.py
+Desсription : Снимок кэшей на диске для быстрого старта после перезапуска
+Author      : Gary Galler
+Copyright(C): Gary Galler, 2017.  All rights reserved
+Version     : 1.0.0.0
+Date        : 24.10.2017
+"""
+#--------------------------------------
+__version__ = '1.0.0.0'
+__date__    = '24.10.2017'
+
+import os
+import mmap
+import marshal
+import struct
+import threading
+
+#---------------------------------
+# формат файла:
+#   MAGIC, длина оглавления (8 байт),
+#   оглавление - marshal словаря {(раздел, ключ): (смещение, длина)},
+#   записи - marshal значений, каждая отдельно
+#---------------------------------
+MAGIC = b"SSNAP\x00\x01\n"
+INDEX_LENGTH = struct.Struct("<Q")
+HEADER_SIZE = len(MAGIC) + INDEX_LENGTH.size
+
+def write_snapshot(path, sections):
+    # sections - {раздел: [(ключ, значение), ...]}, значения из того,
+    # что умеет marshal (числа, строки, кортежи, списки).
+    # Файл пишется рядом и подменяется атомарно, поэтому читатель
+    # никогда не увидит его наполовину записанным
+    index = {}
+    records = []
+    offset = 0
+    for section, items in sections.items():
+        for key, value in items:
+            data = marshal.dumps(value)
+            index[(section, key)] = (offset, len(data))
+            records.append(data)
+            offset += len(data)
+
+    head = marshal.dumps(index)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(INDEX_LENGTH.pack(len(head)))
+            f.write(head)
+            for data in records:
+                f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return len(index)
+
+#---------------------------------
+# чтение снимка
+#---------------------------------
+class Snapshot:
+
+    def __init__(self, path):
+        """Отображает файл снимка в память и читает только оглавление.
+
+        Записи разбираются по одной при первом обращении к ним, так что
+        старт не зависит от размера снимка. Каждая запись выдается
+        один раз: дальше она живет в обычном кэше сервера.
+        Испорченный или чужой файл - ValueError, отсутствующий - OSError
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.mm[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a snapshot file")
+            (length,) = INDEX_LENGTH.unpack_from(self.mm, len(MAGIC))
+            with memoryview(self.mm)[HEADER_SIZE:HEADER_SIZE + length] as view:
+                self.index = marshal.loads(view)
+            if not isinstance(self.index, dict):
+                raise ValueError("malformed snapshot index")
+            self.base = HEADER_SIZE + length
+        except (ValueError, EOFError, TypeError, struct.error) as e:
+            self.mm.close()
+            raise ValueError("%s: %s" % (path, e))
+
+    def pop(self, section, key):
+        # значение записи или None, если ее нет (или она уже выдана)
+        with self.lock:
+            item = self.index.pop((section, key), None)
+            if item is None or self.mm.closed:
+                return None
+            offset, length = item
+            start = self.base + offset
+            try:
+                with memoryview(self.mm)[start:start + length] as view:
+                    return marshal.loads(view)
+            except (ValueError, EOFError, TypeError):
+                return None
+
+    def remaining(self, section):
+        # еще не выданные записи раздела: [(ключ, значение), ...]
+        with self.lock:
+            keys = [key for (s, key) in self.index if s == section]
+        result = []
+        for key in keys:
+            value = self.pop(section, key)
+            if value is not None:
+                result.append((key, value))
+        return result
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        with self.lock:
+            self.index = {}
+            self.mm.close()
@@ -19,33 +19,267 @@ __date__    = '24.10.2017'
 
 
 import time,os,sys
-import traceback 
+import errno
+import math
 import socket
 import mimetypes,cgi
 import re
 import hashlib
 import queue
+import collections
+import asyncio
+import concurrent.futures
+import argparse
+import signal
+import selectors
 import threading
 import locale
+import codecs
+import gzip
+import zlib
+import itertools
+import json
+import logging
 from datetime import datetime
 from string import Template
-from urllib.parse import quote,unquote
+from urllib.parse import quote,unquote,parse_qs
 from subprocess import Popen
 #для автоопределения кодировки файлов
 from chardet.universaldetector import UniversalDetector
+from metrics import Registry, Counter, Gauge, Histogram
+from asynclog import AsyncLog, BufferedFileHandler
+from fswatch import create_watcher
+from httpparser import RequestParser, BodyReader, HTTPError
+from snapshot import Snapshot, write_snapshot
+from ratelimit import ClientLimiter
+# brotli - необязательная зависимость, без нее сжимаем только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from webutils import (
-                    etag, 
-                    is_none_match, 
                     is_modified_since, 
+                    is_range_fresh,
+                    parse_range,
                     get_params_from_header,
-                    time_last_modified_source,
-                    time_to_rfc2616)
+                    acceptable_encodings,
+                    variant_etag,
+                    http_date,
+                    http_date_header,
+                    get_file_meta,
+                    FILE_META_CACHE,
+                    LRUCache)
 
 if os.name == "nt" and sys.version_info[:2] < (3,6):
     import win_unicode_console
     win_unicode_console.enable()
 
 
+#---------------------------------
+# настройки сервера
+#---------------------------------
+HOST = SERVER,PORT = "0.0.0.0",8080
+HOST = ":".join(map(str,HOST))
+# корневая директория, которая будет доступна по адресу http://localhost:8080
+ROOT = os.path.dirname(__file__)
+DEFAULT_CHARSET = "utf-8"
+MAX_AGE = 0
+ENGINE = "threads"    # threads - пул потоков Worker, asyncio - цикл событий asyncio
+# пул воркеров растет от MIN_WORKERS до MAX_WORKERS, когда запросы 
+# ждут в очереди дольше SCALE_UP_WAIT, и сжимается обратно, 
+# когда лишние потоки простаивают WORKER_IDLE_TIMEOUT
+MIN_WORKERS = 8
+MAX_WORKERS = 100
+SCALE_UP_WAIT = 0.005 # сек.
+WORKER_IDLE_TIMEOUT = 30 # сек.
+# очередь к воркерам ограничена: при переполнении клиент сразу 
+# получает 503 с Retry-After вместо бесконечного ожидания
+WORKER_QUEUE_SIZE = 1000
+RETRY_AFTER = 1 # сек.
+# состояние пула воркеров, заполняется create_workers
+q = None              # очередь соединений к воркерам
+threads = []          # потоки Worker
+pool_lock = threading.Lock()
+idle_workers = 0      # воркеры, ждущие соединение из очереди
+# исполнитель движка asyncio, создается serve_async
+executor = None
+executor_pending = 0  # запросов, переданных исполнителю и еще не завершенных
+# лимиты на один адрес клиента, 0 - без ограничения: одновременные
+# соединения, запросы и байты ответов в секунду. Сверх лимита клиент
+# получает 429 с Retry-After прямо из цикла событий, не занимая воркер
+CLIENT_MAX_CONNECTIONS = 0
+CLIENT_REQUEST_RATE = 0      # запросов в секунду
+CLIENT_REQUEST_BURST = 0     # 0 - равен CLIENT_REQUEST_RATE
+CLIENT_BANDWIDTH = 0         # байт в секунду
+CLIENT_BANDWIDTH_BURST = 0   # 0 - равен CLIENT_BANDWIDTH
+LIMIT_SHARDS = 64            # независимых словарей с блокировками
+LIMITER = None
+PROCESSES = 1         # >1 - pre-fork режим, каждый процесс со своим пулом
+REUSE_PORT = False    # SO_REUSEPORT на слушающем сокете (включается в pre-fork)
+ASYNC_EXECUTOR_WORKERS = 32 # потоков для файловых операций в движке asyncio
+# движок asyncio отправляет ответ частями такого размера, и SEND_TIMEOUT 
+# ограничивает каждую часть, а не весь ответ - как простой сокета у воркера
+ASYNC_SEND_WINDOW = 256*1024
+DEPTH_QUEUE_CONNECTIONS = socket.SOMAXCONN # очередь listen (--backlog)
+ACCEPT_BATCH = 64     # максимум соединений, принимаемых за одно пробуждение
+# при нехватке дескрипторов или памяти (EMFILE, ENFILE, ENOBUFS) 
+# прием соединений приостанавливается на это время
+ACCEPT_BACKOFF = 0.1  # сек.
+SELECT_TIMEOUT = 1.0  # сек.
+RECV_SIZE = 65536
+MAX_HEADER_SIZE = 65536 # максимальный размер заголовков запроса, байт
+MAX_HEADERS = 100       # максимальное число заголовков запроса
+MAX_REQUEST_LINE = 8192 # максимальная длина стартовой строки запроса
+MAX_BODY_SIZE = 10*1024*1024 # больше - 413
+BODY_DRAIN_LIMIT = 65536 # непрочитанное тело до этого размера дочитывается,
+                         # чтобы сохранить постоянное соединение
+# перед закрытием соединения с непрочитанным телом запроса дочитываем 
+# его не дольше LINGER_TIMEOUT и не больше LINGER_LIMIT байт: закрытие 
+# сокета с данными в буфере приема - это RST, и клиент может потерять 
+# ответ, который еще не прочитал
+LINGER_TIMEOUT = 2    # сек.
+LINGER_LIMIT = 1024*1024
+READ_TIMEOUT = 10     # сек., время на получение заголовков запроса
+SEND_TIMEOUT = 60     # сек., таймаут отправки ответа воркером
+KEEPALIVE_TIMEOUT = 15 # сек., время простоя постоянного соединения
+MAX_KEEPALIVE_REQUESTS = 100 # запросов на одно постоянное соединение
+USE_SENDFILE = True   # отдавать файлы через os.sendfile, где он есть
+FILE_CHUNK_SIZE = 65536 # размер куска при отдаче файла без sendfile
+# флаг "будут еще данные" для send: заголовки и следующее за ними тело 
+# уходят в общих TCP сегментах (есть только в Linux)
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+LISTING_CACHE_SIZE = 1024 # число каталогов в кэше листингов
+CASCHE_DIRS = LRUCache(maxsize=LISTING_CACHE_SIZE)
+# путь запроса -> Resolved: путь на диске, MIME тип и способ отдачи
+RESOLVE_CACHE_SIZE = 65536
+RESOLVE_CACHE = LRUCache(maxsize=RESOLVE_CACHE_SIZE)
+# каталоги длиннее порога отдаются потоком (chunked) без кэша страницы
+LISTING_STREAM_THRESHOLD = 5000
+LISTING_CHUNK_SIZE = 500 # строк листинга в одной части ответа
+# как часто сверять кэш метаданных файлов с диском, сек.;
+# 0 - один stat на каждый запрос
+META_TTL = 0
+# кэш результатов определения кодировки текстовых файлов
+ENCODING_CACHE_SIZE = 4096
+ENCODING_CACHE = LRUCache(maxsize=ENCODING_CACHE_SIZE)
+DETECT_LIMIT = 65536  # сколько байт файла смотреть, 0 - весь файл
+# кэш готовых ответов на небольшие файлы (иконки, css, json)
+HOT_FILE_MAX_SIZE = 65536       # файлы крупнее в кэш не попадают
+HOT_CACHE_BYTES = 64*1024*1024  # общий объем кэша
+HOT_FILES = LRUCache(maxsize=100000, maxbytes=HOT_CACHE_BYTES)
+# сжатие ответов
+COMPRESS = True
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 1024  # меньше - сжатие не окупается
+# файлы до этого размера сжимаются целиком и кэшируются, 
+# крупнее - сжимаются потоком при каждой отдаче
+COMPRESS_CACHE_MAX_SIZE = 8*1024*1024
+COMPRESS_CACHE_BYTES = 128*1024*1024
+COMPRESSED = LRUCache(maxsize=100000, maxbytes=COMPRESS_CACHE_BYTES)
+# поддерживаемые кодировки в порядке предпочтения и суффиксы сжатых копий
+CONTENT_CODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+CODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# наблюдение за каталогами под ROOT: изменения сбрасывают кэши 
+# по конкретным путям, а закэшированное отдается без stat
+FS_WATCH = "auto"        # auto (inotify, если есть), inotify, poll или off
+FS_POLL_INTERVAL = 2.0   # сек., для наблюдения опросом
+FS_MAX_WATCHES = 8192
+WATCHER = None
+# снимок кэшей листингов и кодировок: пишется при остановке и читается
+# после перезапуска, записи сверяются с диском по mtime и размеру
+SNAPSHOT_FILE = None     # None - без снимка
+SNAPSHOT = None
+# фоновый обход ROOT, заранее заполняющий кэши листингов, метаданных
+# и кодировок; уступает живым запросам и ограничен по скорости
+CRAWL = False
+CRAWL_DEPTH = 4          # 0 - только сам ROOT
+CRAWL_RATE = 500         # обращений к диску в секунду
+CRAWL_BACKOFF = 0.1      # сек., пауза, пока сервер занят запросами
+CRAWLER = None
+# метрики
+METRICS_ENABLED = True
+METRICS_PATH = "/__metrics"
+# логи: сообщения сервера и журнал запросов пишет фоновый поток
+LOG_LEVEL = "INFO"
+LOG_FILE = None          # None - stderr
+ACCESS_LOG = "-"         # "-" - stdout, None - не вести
+ACCESS_LOG_FORMAT = "combined" # common, combined или json
+LOG_QUEUE_SIZE = 10000   # при переполнении записи теряются, а не ждут
+LOG_BUFFER_SIZE = 65536
+LOG_FLUSH_INTERVAL = 1.0
+
+if not mimetypes.inited:
+    mimetypes.init() 
+
+# добавляем и переопределяем некоторые mime типы
+mimetypes.types_map.update(
+    {
+    ""     :'application/octet-stream', # файлам без расширения дадим дефолтный тип неизвестного двоичного содержимого 
+    ".json":"application/json", # отсутствует
+    ".vbs" :"text/plain",       # отсутствует, определяем для открытия в браузере
+    ".csv" :"text/plain",       # переопределяем для открытия в браузере
+    ".djvu":"application/djvu", # отсутствует
+    ".js"  :"text/plain",       # переопределяем для открытия в браузере
+    }
+    )
+
+# типы, которые нужно открывать текстовом режиме и декодировать
+text_types = re.compile("|".join(
+    ["text/.*","application/json"]
+    ))
+# типы, которые имеет смысл сжимать
+compressible_types = re.compile("|".join(
+    [
+    "text/.*",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg\\+xml",
+    ]
+    ))
+
+# типы, которые мы хотим, чтобы браузер открывал сам
+# любые текстовые файлы, картинки, видео (если,получится)
+browser_types = re.compile("|".join(
+    [
+    "application/json",
+    "application/pdf",
+    "image/.*",
+    "video/.*"
+    ]
+    ))
+
+# xlsx:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet
+# exe: application/x-msdownload
+
+#---------------------------------
+# таблица типов по расширению
+#---------------------------------
+class MimeInfo:
+    __slots__ = ("mime", "disposition", "compressible")
+    
+    def __init__(self, mime):
+        """Как отдавать файлы этого типа: считается один раз на расширение"""
+        self.mime = mime
+        # text - текст, кодировку определяем; inline - браузер откроет сам;
+        # attachment - диалог сохранения файла
+        if text_types.match(mime):
+            self.disposition = "text"
+        elif browser_types.match(mime):
+            self.disposition = "inline"
+        else:
+            self.disposition = "attachment"
+        self.compressible = bool(compressible_types.match(mime))
+
+DEFAULT_MIME = MimeInfo("application/octet-stream")
+MIME_TABLE = {ext.lower(): MimeInfo(mime) for ext, mime in mimetypes.types_map.items()}
+
+def mime_info(filepath):
+    _, ext = os.path.splitext(filepath)
+    return MIME_TABLE.get(ext.lower(), DEFAULT_MIME)
+
+
 #---------------------------------
 # базовый шаблон html
 #---------------------------------
@@ -74,75 +308,426 @@ BASE_HTML = """
 # дебаговый вывод информации
 #---------------------------------
 def debug_response_headers(response):
-    print("-"*10)
-    print("RESPONSE:")
-    print(response.version,response.status)
-    
-    for name,val in response.headers:
-        print(name,val,sep=': ')
+    # заголовки собираются в строку только при уровне DEBUG
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    log.debug("RESPONSE: %s %s\n%s", response.version, response.status,
+              "\n".join("%s: %s" % (name,val) for name,val in response.headers))
 
 
 def debug_request_headers(request):
-    print("-"*10)
-    print("CONNECTED:",request.host)
-    print(
-        request.method, 
-        unquote(request.address),
-        request.version
-    )
-    
-    for name,val in request.headers:
-        print(name,val,sep=': ')
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    log.debug("REQUEST from %s: %s %s %s\n%s", request.host, request.method,
+              unquote(request.address), request.version,
+              "\n".join("%s: %s" % (name,val) for name,val in request.headers))
 
 
 #---------------------------------
-# чтение файла
+# потоковая отправка файла
 #---------------------------------
-def read_file(filepath):
-    data = open(filepath,"rb").read()
-    return data,int(len(data))
+def send_file(conn, fileobj, offset=0, count=None):
+    # файл не читается в память целиком: в Linux данные идут 
+    # через os.sendfile из кэша страниц прямо в сокет, минуя Python,
+    # иначе - кусками фиксированного размера через один и тот же буфер
+    if head_only():
+        return 0
+    if USE_SENDFILE and hasattr(os, "sendfile"):
+        start = time.perf_counter()
+        sent = conn.sendfile(fileobj, offset, count)
+        count_sent(sent or 0)
+        observe("send", start)
+        return sent
+    return send_file_chunks(conn, fileobj, offset, count)
+
+def send_file_chunks(conn, fileobj, offset=0, count=None):
+    buffer = memoryview(bytearray(FILE_CHUNK_SIZE))
+    fileobj.seek(offset)
+    total = 0
+    
+    while count is None or total < count:
+        size = FILE_CHUNK_SIZE if count is None else min(FILE_CHUNK_SIZE, count - total)
+        start = time.perf_counter()
+        n = fileobj.readinto(buffer[:size])
+        observe("file_io", start)
+        if not n:
+            break
+        send_buffers(conn, [buffer[:n]])
+        total += n
+    
+    return total
 
 #---------------------------------
 # определение кодировки файла
 #---------------------------------
-def detect_encoding(filepath):
+def detect_encoding(filepath, limit=None, st=None):
+    # результат определяется один раз на версию файла (mtime и размер)
+    if limit is None:
+        limit = DETECT_LIMIT
+    if st is None:
+        st = os.stat(filepath)
+    
+    cached = ENCODING_CACHE.get(filepath)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    if cached is None:
+        cached = from_snapshot("encoding", filepath, st)
+        if cached is not None:
+            ENCODING_CACHE.set(filepath, cached)
+            return cached[2]
+    
+    start = time.perf_counter()
+    encoding = _detect_encoding(filepath, limit)
+    observe("encoding", start)
+    ENCODING_CACHE.set(filepath, (st.st_mtime_ns, st.st_size, encoding))
+    return encoding
+
+def _detect_encoding(filepath, limit=0):
     #default_enc = sys.getfilesystemencoding()
     default_enc = locale.getpreferredencoding()
     result = None
     detector = UniversalDetector()
     detector.reset()
     
-    for line in open(filepath, 'rb'):
-        detector.feed(line)
-        if detector.done: break
-    detector.close()
-    encoding = detector.result.get('encoding') or default_enc
+    # без ограничения - старый путь: файл скармливается chardet построчно
+    if not limit:
+        with open(filepath, 'rb') as f:
+            for line in f:
+                detector.feed(line)
+                if detector.done: break
+        detector.close()
+        return detector.result.get('encoding') or default_enc
     
-    return encoding
+    # иначе смотрим только первые limit байт
+    with open(filepath, 'rb') as f:
+        head = f.read(limit + 1)
+    truncated = len(head) > limit
+    head = head[:limit]
+    
+    # быстрый путь без chardet: чистый ASCII и корректный UTF-8.
+    # Для обрезанного начала ASCII считаем UTF-8 (его надмножеством),
+    # а обрезанный посередине многобайтный символ не считаем ошибкой
+    try:
+        head.decode('ascii')
+        return 'utf-8' if truncated else 'ascii'
+    except UnicodeDecodeError:
+        pass
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=not truncated)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    
+    detector.feed(head)
+    detector.close()
+    return detector.result.get('encoding') or default_enc
 
 #---------------------------------
 # листинг каталогов
 #---------------------------------
+class Listing:
+    
+    def __init__(self, mtime, entries, generation=None, size=None):
+        """Содержимое каталога на момент mtime"""
+        self.mtime = mtime
+        self.size = size # размер каталога, для сверки снимка кэша
+        self.generation = generation # поколение каталога в наблюдателе
+        # кортежи (имя, это_каталог, размер): сначала каталоги, потом файлы
+        self.entries = entries
+        # готовые страницы листинга по (заголовок, кодировка)
+        self.html = {}
+
 def list_directory(root):
+    # за наблюдаемым каталогом следит WATCHER: пока поколение каталога
+    # не изменилось, листинг отдается из кэша вообще без обращения к диску
+    generation = watch_directory(root)
+    listing = CASCHE_DIRS.get(root)
+    if listing is not None and generation is not None and listing.generation == generation:
+        return listing
+    
+    # иначе кэш проверяется одним вызовом stat: добавление, удаление или
+    # переименование файла меняет mtime каталога, и листинг строится заново
+    st = os.stat(root)
+    mtime = st.st_mtime_ns
+    if listing is not None and generation is None and listing.mtime == mtime:
+        return listing
+    
+    # после перезапуска листинг может найтись в снимке кэша
+    if listing is None:
+        item = from_snapshot("listing", root, st)
+        if item is not None:
+            listing = Listing(mtime, item[2], generation, st.st_size)
+            CASCHE_DIRS.set(root, listing)
+            return listing
     
     dirs  = []
     files = []
     
-    cache_dirs = CASCHE_DIRS.get(root)
-    if cache_dirs:
-        return cache_dirs
-    
-    for name in os.listdir(root):
-        if os.path.isdir(os.path.join(root,name)):
-            dirs.append(name.upper() + "/")
-        else:
-            files.append(name)
+    # тип берем из самой записи каталога, а размер - из ее stat
+    # за один проход, без отдельных isdir/getsize на каждое имя
+    with os.scandir(root) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    dirs.append((entry.name, True, 0))
+                else:
+                    files.append((entry.name, False, entry.stat().st_size))
+            except OSError: # файл успели удалить
+                continue
     
     dirs.sort()
     files.sort()
     dirs.extend(files)
-    CASCHE_DIRS[root] = dirs
-    return dirs
+    listing = Listing(mtime, dirs, generation, st.st_size)
+    CASCHE_DIRS.set(root, listing)
+    return listing
+
+#---------------------------------
+# наблюдение за файловой системой
+#---------------------------------
+def watch_directory(dirpath):
+    # поколение каталога или None, если он не наблюдается;
+    # каталоги под ROOT начинают наблюдаться при первом обращении
+    watcher = WATCHER
+    if watcher is None:
+        return None
+    generation = watcher.generation(dirpath)
+    if generation is None:
+        root = os.path.normpath(ROOT)
+        if ((dirpath == root or dirpath.startswith(root + os.sep)) and 
+                watcher.watch(dirpath)):
+            generation = watcher.generation(dirpath)
+    return generation
+
+def file_meta(filepath):
+    # метаданные файла в наблюдаемом каталоге не сверяются с диском,
+    # пока каталог не изменился
+    generation = watch_directory(os.path.dirname(filepath))
+    if generation is not None:
+        meta = FILE_META_CACHE.get(filepath)
+        if meta is not None and meta.generation == generation:
+            return meta
+    # поколение прочитано до stat, поэтому изменение, случившееся
+    # во время проверки, не останется незамеченным
+    meta = get_file_meta(filepath, ttl=META_TTL)
+    meta.generation = generation
+    return meta
+
+def invalidate_path(dirpath, name):
+    # вызывается наблюдателем из своего потока
+    if dirpath is None:
+        for cache in (CASCHE_DIRS, FILE_META_CACHE, ENCODING_CACHE, HOT_FILES, COMPRESSED):
+            cache.clear()
+        return
+    # изменилось содержимое каталога - и его листинг, и mtime
+    CASCHE_DIRS.pop(dirpath)
+    FILE_META_CACHE.pop(dirpath)
+    if name is None:
+        return
+    
+    path = os.path.join(dirpath, name)
+    paths = [path]
+    # появилась или исчезла сжатая копия - у оригинала меняется список вариантов
+    for suffix in CODING_SUFFIXES.values():
+        if name.endswith(suffix):
+            paths.append(path[:-len(suffix)])
+    for p in paths:
+        meta = FILE_META_CACHE.pop(p)
+        if meta is not None:
+            for coding in CODING_SUFFIXES:
+                COMPRESSED.pop((meta.etag, coding))
+        ENCODING_CACHE.pop(p)
+        HOT_FILES.pop(p)
+        CASCHE_DIRS.pop(p)
+
+def start_watcher():
+    global WATCHER
+    if FS_WATCH == "off" or WATCHER is not None:
+        return
+    try:
+        WATCHER = create_watcher(invalidate_path, FS_WATCH, 
+                                 max_watches=FS_MAX_WATCHES, 
+                                 interval=FS_POLL_INTERVAL)
+    except OSError:
+        log.exception("Watcher: inotify is not available")
+        WATCHER = None
+    if WATCHER is not None:
+        WATCHER.start()
+        log.info("Watcher: %s", type(WATCHER).__name__)
+    else:
+        log.info("Watcher: off, caches are revalidated with stat")
+
+def stop_watcher():
+    global WATCHER
+    if WATCHER is not None:
+        WATCHER.stop()
+        WATCHER = None
+
+#---------------------------------
+# снимок кэшей для быстрого старта
+#---------------------------------
+def from_snapshot(section, key, st):
+    # запись снимка (mtime_ns, размер, ...) или None, если ее нет 
+    # или файл на диске с тех пор изменился
+    snapshot = SNAPSHOT
+    if snapshot is None:
+        return None
+    item = snapshot.pop(section, key)
+    if item is None or item[0] != st.st_mtime_ns or item[1] != st.st_size:
+        return None
+    return item
+
+def load_snapshot():
+    global SNAPSHOT
+    if not SNAPSHOT_FILE or SNAPSHOT is not None:
+        return
+    try:
+        SNAPSHOT = Snapshot(SNAPSHOT_FILE)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log.warning("Snapshot: not loaded: %s", e)
+        return
+    log.info("Snapshot: %s entries in %s", len(SNAPSHOT), SNAPSHOT_FILE)
+
+def save_snapshot():
+    global SNAPSHOT
+    if not SNAPSHOT_FILE:
+        return
+    sections = {
+        "listing": dict((root, (listing.mtime, listing.size, listing.entries))
+                        for root, listing in CASCHE_DIRS.items()
+                        if listing.size is not None),
+        "encoding": dict(ENCODING_CACHE.items()),
+    }
+    limits = {"listing": CASCHE_DIRS.maxsize, "encoding": ENCODING_CACHE.maxsize}
+    snapshot, SNAPSHOT = SNAPSHOT, None
+    if snapshot is not None:
+        # записи прошлого снимка, до которых дело не дошло, переносятся
+        # в новый - иначе два быстрых перезапуска подряд остудят кэш
+        for section, items in sections.items():
+            for key, value in snapshot.remaining(section):
+                if len(items) >= limits[section]:
+                    break
+                items.setdefault(key, value)
+        snapshot.close()
+    try:
+        count = write_snapshot(SNAPSHOT_FILE, 
+                               dict((k, v.items()) for k, v in sections.items()))
+    except OSError as e:
+        log.warning("Snapshot: not saved: %s", e)
+        return
+    log.info("Snapshot: %s entries saved to %s", count, SNAPSHOT_FILE)
+
+#---------------------------------
+# фоновый прогрев кэшей
+#---------------------------------
+class Crawler(threading.Thread):
+    
+    def __init__(self, root, depth=CRAWL_DEPTH, rate=CRAWL_RATE):
+        """Обходит root в ширину до глубины depth и заполняет те же кэши,
+        что и запросы: list_directory, file_meta, detect_encoding.
+        
+        Работает, только пока у сервера есть свободные воркеры, делает 
+        не больше rate обращений к диску в секунду и останавливается, 
+        когда кэши заполнены - иначе прогрев вытеснял бы из них то, 
+        что действительно запрашивают
+        """
+        super().__init__(name="Crawler", daemon=True)
+        self.root = os.path.normpath(root)
+        self.depth = depth
+        self.rate = rate
+        self.stopped = threading.Event()
+        self.next_time = time.monotonic()
+        self.dirs = 0
+        self.files = 0
+    
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+    
+    def pace(self, cost=1):
+        # cost - число обращений к диску, которое предстоит сделать;
+        # False - обход пора прекратить
+        now = time.monotonic()
+        start = max(self.next_time, now)
+        self.next_time = start + cost / self.rate
+        if self.stopped.wait(start - now):
+            return False
+        while server_busy():
+            if self.stopped.wait(CRAWL_BACKOFF):
+                return False
+        return True
+    
+    def run(self):
+        started = time.monotonic()
+        try:
+            self.crawl()
+        except Exception:
+            log.exception("Crawler: failed")
+        log.info("Crawler: %s directories, %s files in %.1fs", 
+                 self.dirs, self.files, time.monotonic() - started)
+    
+    def crawl(self):
+        max_dirs = CASCHE_DIRS.maxsize
+        max_files = FILE_META_CACHE.maxsize
+        todo = collections.deque([(self.root, 0)])
+        while todo:
+            dirpath, depth = todo.popleft()
+            if self.dirs >= max_dirs or not self.pace():
+                return
+            try:
+                listing = list_directory(dirpath)
+            except OSError:
+                continue
+            self.dirs += 1
+            
+            for name, is_dir, size in listing.entries:
+                path = os.path.join(dirpath, name)
+                if is_dir:
+                    if depth < self.depth:
+                        todo.append((path, depth + 1))
+                    continue
+                if self.files >= max_files:
+                    break
+                if not self.pace():
+                    return
+                self.warm_file(path)
+    
+    def warm_file(self, path):
+        try:
+            meta = file_meta(path)
+        except OSError:
+            return
+        self.files += 1
+        if meta.charset is None and mime_info(path).disposition == "text":
+            # кодировка определяется по первым DETECT_LIMIT байтам
+            if not self.pace(1 + min(meta.size, DETECT_LIMIT or meta.size) // FILE_CHUNK_SIZE):
+                return
+            try:
+                meta.charset = detect_encoding(path, st=meta.stat)
+            except OSError:
+                pass
+
+def server_busy():
+    # живые запросы ждут в очереди или свободных воркеров не осталось
+    if queue_depth():
+        return True
+    return ENGINE != "asyncio" and not idle_workers
+
+def start_crawler():
+    global CRAWLER
+    if not CRAWL or CRAWLER is not None:
+        return
+    CRAWLER = Crawler(ROOT, depth=CRAWL_DEPTH, rate=CRAWL_RATE)
+    CRAWLER.start()
+
+def stop_crawler():
+    global CRAWLER
+    if CRAWLER is not None:
+        CRAWLER.stop()
+        CRAWLER = None
 
 #---------------------------------
 # генерация страницы ошибки
@@ -163,45 +748,133 @@ def render_error(**kwargs):
 #---------------------------------
 # генерация страницы листинга файлов
 #---------------------------------    
-def render_html(root,charset=None):
+def render_html(root,charset=None,coding=None):
     
     if charset is None:
         charset = "utf-8"
+    title,filepath = listing_path(root)
+    listing = list_directory(filepath)
+    # страница строится один раз на каждую версию каталога
+    html = listing.html.get((title,charset))
+    if html is None:
+        html = "".join(iter_html(root,charset,listing=listing))
+        listing.html[(title,charset)] = html
+    if not coding:
+        return html
+    # сжатая страница (bytes) кэшируется рядом с обычной
+    data = listing.html.get((title,charset,coding))
+    if data is None:
+        data = compress(html.encode(charset), coding)
+        listing.html[(title,charset,coding)] = data
+    return data
+
+def listing_path(root):
+    # заголовок страницы и путь к каталогу на диске
     root = unquote(root)
     root = root if root != ROOT else '/'
+    return root,os.path.normpath(os.path.join(ROOT,root.strip('/')))
+
+def iter_html(root,charset=None,offset=0,limit=None,listing=None):
+    # страница листинга отдается по частям: сначала шапка, 
+    # потом записи пачками по LISTING_CHUNK_SIZE, потом подвал.
+    # Ни вся страница, ни весь список строк в памяти не собираются
+    if charset is None:
+        charset = "utf-8"
+    root,filepath = listing_path(root)
+    if listing is None:
+        listing = list_directory(filepath)
+    entries = listing.entries
     
-    html = BASE_HTML
-   
-    body = """<h1>Index of %s </h1>\n<hr>\n<ul>\n""" % root
-    li = """<li><a  href="{name}" title={title}>{name}</a></li>\n"""
+    head,tail = BASE_HTML.split("$body")
+    head = Template(head).safe_substitute(title=root,charset=charset)
+    
+    li = """<li><a  href="{href}" title={title}>{name}</a></li>\n"""
+    body = [head, """<h1>Index of %s </h1>\n<hr>\n<ul>\n""" % root]
     #добавляем в самый верх относительную ссылку на родительский каталог
-    body += li.format(name="../",title="")
+    body.append(li.format(href="../",name="../",title=""))
     
+    stop = len(entries) if limit is None else min(len(entries), offset + limit)
     # сортировка файлов и директорий - первыми идут каталоги
-    filepath = os.path.normpath(os.path.join(ROOT,root.strip('/')))
-    listing = list_directory(filepath)
-    
-    for name in listing: 
-        path = os.path.join(filepath,name)
-        if not os.path.isdir(path):
-            size = os.path.getsize(path)
+    for i in range(offset, stop):
+        name,is_dir,size = entries[i]
+        if not is_dir:
             if size > 1024: 
                 size = str(round(size/1024)) + " kb" 
             else: 
                 size = str(round(size)) + " byte"
-            size = "Size: {}".format(size)
+            size = '"Size: {}"'.format(size)
+            href = name
         else:
             size = '""'
-        body+= li.format(name=name,
-                        title='"' + size + '"')
+            href = name + "/"
+            name = name.upper() + "/"
+        body.append(li.format(href=href,
+                        name=name,
+                        title=size))
+        if len(body) >= LISTING_CHUNK_SIZE:
+            yield "".join(body)
+            body = []
     
-    body+= "</ul>\n<hr>\n"
-    html = Template(html)
-    return html.safe_substitute(title=root,
-                                charset=charset,
-                                body=body)
+    body.append("</ul>\n<hr>\n")
+    # ссылки на соседние страницы при постраничном выводе
+    if limit is not None:
+        if offset > 0:
+            body.append('<a href="?offset={}&limit={}">&lt;&lt; prev</a>\n'.format(
+                max(0, offset - limit), limit))
+        if stop < len(entries):
+            body.append('<a href="?offset={}&limit={}">next &gt;&gt;</a>\n'.format(
+                stop, limit))
+    body.append(tail)
+    yield "".join(body)
     
 
+#---------------------------------
+# объекты запроса и ответа
+#---------------------------------
+class Request:
+    __slots__ = ("host", "method", "address", "path", "query", 
+                 "version", "headers", "keep_alive", "body")
+    
+    def __init__(self, method, address, version, headers, host, keep_alive, body=None):
+        self.method = method
+        self.address = address
+        self.path, _, self.query = address.partition("?")
+        self.version = version
+        self.headers = headers
+        self.host = host
+        self.keep_alive = keep_alive
+        self.body = body # BodyReader или None, если тела нет
+
+class Response:
+    __slots__ = ("version", "status", "headers")
+    
+    def __init__(self, version, status, headers):
+        self.version = version
+        self.status = status
+        self.headers = headers
+
+# заголовки, одинаковые для всех ответов, кодируются один раз
+SERVER_HEADER = ("Server", "simplehttp")
+CONNECTION_HEADERS = {
+    True: ("Connection", "keep-alive"),
+    False: ("Connection", "close"),
+}
+ENCODED_HEADERS = {
+    header: ("%s: %s\r\n" % header).encode("ascii") 
+    for header in [SERVER_HEADER] + list(CONNECTION_HEADERS.values())
+}
+STATUS_LINES = {}
+
+def encode_headers(headers):
+    return "".join("%s: %s\r\n" % header for header in headers).encode(DEFAULT_CHARSET)
+
+def status_line(protocol, status):
+    line = STATUS_LINES.get((protocol, status))
+    if line is None:
+        line = STATUS_LINES[(protocol, status)] = (
+                    "{} {}\r\n".format(protocol, status).encode(DEFAULT_CHARSET))
+    return line
+
 #---------------------------------
 # отправка ответа клиенту
 #---------------------------------
@@ -213,7 +886,13 @@ def send_answer(conn,
                 charset=None, 
                 data="",
                 binary=False,
-                headers=None):
+                headers=None,
+                keep_alive=False,
+                content_length=None,
+                chunked=False):
+    # content_length задается, когда тело ответа отправляется 
+    # отдельно (например, через send_file), а data пустые;
+    # chunked - тело пойдет частями через send_chunked
     
     if not binary and data:
         if charset is None:
@@ -221,150 +900,848 @@ def send_answer(conn,
         data = data.encode(charset)
     
     charset = '; charset=' + charset if charset else ""
-    start_line = "{} {}".format(protocol, status)
+    # постоянные заголовки берутся уже закодированными, 
+    # а Date - из кэша, обновляемого раз в секунду
+    date = http_date()
+    head = [status_line(protocol, status)]
     default_headers = [
-            ("Server", "simplehttp"),
-            ("Date", time_to_rfc2616()),
-            ("Connection", "close"),
-            ("Content-Type", typ + charset),
-            ("Content-Length", len(data)),
+            SERVER_HEADER,
+            ("Date", date),
+            CONNECTION_HEADERS[keep_alive],
         ]
+    dynamic_headers = []
+    # у ответов 204 и 304 тела нет по определению
+    if status[:3] not in ("204", "304"):
+        dynamic_headers.append(("Content-Type", typ + charset))
+        if chunked:
+            dynamic_headers.append(("Transfer-Encoding", "chunked"))
+        # без длины и без chunked (клиенты HTTP/1.0) конец тела - закрытие соединения
+        elif chunked is not None:
+            dynamic_headers.append(
+                ("Content-Length", len(data) if content_length is None else content_length))
     
-    _headers = []
     if headers is None:
         headers = []
     elif headers == -1:
         headers = []
         default_headers = []
+        dynamic_headers = []
     
-    _headers.extend(default_headers)
-    _headers.extend(headers)
-    # динамически создаем простой объект для передачи данных ответа
-    response = type("Response",(object,), {
-        'version':protocol,
-        'status':status,
-        'headers':_headers
-        }
-    )
+    if default_headers:
+        head.append(ENCODED_HEADERS[SERVER_HEADER])
+        head.append(http_date_header())
+        head.append(ENCODED_HEADERS[CONNECTION_HEADERS[keep_alive]])
+    dynamic_headers.extend(headers)
     
+    response = Response(protocol, status, default_headers + dynamic_headers)
     debug_response_headers(response)
-    conn.send(start_line.encode(DEFAULT_CHARSET) + b"\r\n") 
+    count_response(status[:3])
+    # стартовая строка и заголовки собираются в один буфер;
+    # пустая строка завершает заголовки даже без тела - 
+    # иначе клиент на постоянном соединении не найдет конец ответа
+    head.append(encode_headers(dynamic_headers))
+    head.append(b"\r\n") # после пустой строки в HTTP начинаются данные
+    head = b"".join(head)
+    
+    if head_only():
+        # ответ на HEAD - только заголовки с длиной тела, без самого тела
+        send_buffers(conn, [head])
+    elif data:
+        # заголовки и тело уходят одним вызовом sendmsg
+        send_buffers(conn, [head, data])
+    else:
+        # если тело пойдет следом (send_file, send_chunked), просим ядро
+        # не отправлять заголовки отдельным мелким сегментом
+        more = content_length or chunked
+        send_buffers(conn, [head], MSG_MORE if more else 0)
+
+#---------------------------------
+# отправка нескольких буферов одним системным вызовом
+#---------------------------------
+def send_buffers(conn, buffers, flags=0):
+    # scatter-gather через sendmsg без склейки буферов в памяти.
+    # sendmsg может отправить только часть данных (а неблокирующий 
+    # сокет - вернуть EAGAIN), поэтому досылаем остаток сами
+    start = time.perf_counter()
+    if not hasattr(conn, "sendmsg"): # Windows, AsyncConnection
+        data = b"".join(buffers)
+        conn.sendall(data)
+        count_sent(len(data))
+        return observe("send", start)
     
-    if _headers:
-        for header in _headers:
-            conn.send(": ".join(map(str,header)).encode(DEFAULT_CHARSET) + b"\r\n")     
+    buffers = [memoryview(b).cast("B") for b in buffers if b]
+    count_sent(sum(len(b) for b in buffers))
+    while buffers:
+        try:
+            sent = conn.sendmsg(buffers, [], flags)
+        except (BlockingIOError, InterruptedError):
+            wait_writable(conn)
+            continue
+        # отбрасываем уже отправленное
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+    observe("send", start)
+
+def wait_writable(conn, timeout=None):
+    if timeout is None:
+        timeout = SEND_TIMEOUT
+    with selectors.DefaultSelector() as sel:
+        sel.register(conn, selectors.EVENT_WRITE)
+        if not sel.select(timeout):
+            raise socket.timeout("send timed out")
+    
+#---------------------------------
+# состояние клиентского соединения
+#---------------------------------
+class Connection:
+    
+    def __init__(self, conn, addr, limited=False):
+        """Сокет клиента и буфер для накопления запроса"""
+        self.conn = conn
+        self.addr = addr
+        self.limited = limited # соединение учтено в LIMITER
+        self.admitted = False  # первый запрос уже пропущен лимитом запросов
+        # в буфере может лежать сразу несколько конвейерных запросов
+        self.buffer = bytearray()
+        self.requests = 0 # число обслуженных запросов
+        # время, до которого клиент должен прислать заголовки запроса
+        self.deadline = time.monotonic() + READ_TIMEOUT
+        self.queued = None # момент передачи воркеру
+        self.closed = False
+        self.parser = RequestParser(MAX_HEADER_SIZE, MAX_HEADERS, 
+                                    MAX_REQUEST_LINE, MAX_BODY_SIZE)
+        self.head = None # заголовки запроса, разобранные циклом событий
+        # в сокете осталось непрочитанное тело запроса - закрывать через linger
+        self.linger = False
+        CONNECTIONS.inc(("opened",))
+    
+    def fileno(self):
+        return self.conn.fileno()
+    
+    def feed(self, tmp):
+        # добавляет принятые данные в буфер и разбирает их по мере поступления;
+        # результат - как у read_data, некорректный запрос - HTTPError
+        if not tmp:   # сокет закрыли, пустой объект
+            return None
         
-    if data:
-        conn.send(b"\r\n") # после пустой строки в HTTP начинаются данные
-        conn.send(data)
+        buffer = self.buffer
+        if not buffer: 
+            # начало нового запроса - отсчитываем время на его получение
+            self.deadline = time.monotonic() + READ_TIMEOUT
+        buffer += tmp
+        if self.head is None:
+            self.head = self.parser.parse(buffer)
+        return self.head is not None
+    
+    def next_request(self):
+        # заголовки очередного запроса (RequestHead), если они пришли целиком
+        head = self.head
+        if head is not None:
+            self.head = None
+            return head
+        return self.parser.parse(self.buffer)
     
+    def body(self, head, recv):
+        # тело запроса читается воркером из буфера и сокета по мере надобности
+        if not head.has_body:
+            return None
+        return BodyReader(self.buffer, recv, head, 
+                          max_body_size=MAX_BODY_SIZE, 
+                          recv_size=RECV_SIZE)
+    
+    def lingering_close(self):
+        # закрываем только свою сторону, чтобы клиент получил FIN после ответа,
+        # и отбрасываем то, что он еще успеет прислать, - тогда ядро 
+        # не ответит RST. Вызывается в потоке воркера, сокет блокирующий
+        try:
+            self.conn.shutdown(socket.SHUT_WR)
+            deadline = time.monotonic() + LINGER_TIMEOUT
+            total = 0
+            while total < LINGER_LIMIT:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.conn.settimeout(timeout)
+                data = self.conn.recv(RECV_SIZE)
+                if not data:
+                    break
+                total += len(data)
+        except OSError:
+            pass
+        self.close()
+    
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            CONNECTIONS.inc(("closed",))
+            if self.limited:
+                LIMITER.disconnect(self.addr[0])
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
 #---------------------------------
-# чтение данных из сокета  
+# кэш небольших часто запрашиваемых файлов
 #---------------------------------
-def read_data(conn, addr):
-    data = b""
+class HotFile:
     
-    while not b"\r\n" in data: # ждём первую строку
-        time.sleep(0.1)
+    def __init__(self, meta, headers, body):
+        """Готовый ответ на файл: закодированные заголовки и тело"""
+        self.mtime = meta.stat.st_mtime_ns
+        self.size = meta.size
+        self.headers = headers
+        # все заголовки, кроме Server/Date/Connection, и пустая строка
+        self.tail = encode_headers(headers) + b"\r\n"
+        self.body = body
+    
+    def is_actual(self, meta):
+        return self.mtime == meta.stat.st_mtime_ns and self.size == meta.size
+
+def cache_hot_file(filepath, meta, fileobj, typ, charset, headers):
+    # читает небольшой файл целиком и кладет в кэш готовый ответ на него;
+    # если файл успел измениться - не кэширует
+    start = time.perf_counter()
+    body = fileobj.read(meta.size + 1)
+    observe("file_io", start)
+    if len(body) != meta.size:
+        return None
+    charset = '; charset=' + charset if charset else ""
+    headers = [("Content-Type", typ + charset), 
+               ("Content-Length", len(body))] + headers
+    hot = HotFile(meta, headers, body)
+    HOT_FILES.set(filepath, hot, size=len(hot.tail) + len(body))
+    return hot
+
+def send_hot_file(conn, hot, keep_alive=False, protocol="HTTP/1.1"):
+    # ответ целиком из памяти, одним sendmsg
+    status = "200 OK"
+    debug_response_headers(Response(protocol, status, 
+            [SERVER_HEADER, ("Date", http_date()), CONNECTION_HEADERS[keep_alive]] + hot.headers))
+    count_response("200")
+    send_buffers(conn, [
+        status_line(protocol, status),
+        ENCODED_HEADERS[SERVER_HEADER],
+        http_date_header(),
+        ENCODED_HEADERS[CONNECTION_HEADERS[keep_alive]],
+        hot.tail,
+        b"" if head_only() else hot.body,
+    ])
+
+#---------------------------------
+# метрики: время этапов обработки, счетчики ответов и кэшей
+#---------------------------------
+REGISTRY = Registry()
+STAGE_TIME = REGISTRY.register(Histogram("server_stage_seconds",
+        "Time spent in request processing stages", ("stage",)))
+RESPONSES = REGISTRY.register(Counter("server_responses_total",
+        "Responses sent by status code", ("status",)))
+BYTES_SENT = REGISTRY.register(Counter("server_sent_bytes_total",
+        "Bytes written to client sockets"))
+CONNECTIONS = REGISTRY.register(Counter("server_connections_total",
+        "Client connections opened and closed", ("event",)))
+
+def observe(stage, start):
+    # start - значение time.perf_counter() в начале этапа
+    if METRICS_ENABLED:
+        STAGE_TIME.observe(time.perf_counter() - start, (stage,))
+
+def active_connections():
+    values = CONNECTIONS.values
+    return values.get(("opened",), 0) - values.get(("closed",), 0)
+
+def queue_depth():
+    # соединения, ждущие свободного воркера (или потока исполнителя asyncio)
+    if ENGINE == "asyncio":
+        # сверх числа потоков исполнителя запросы ждут в его очереди
+        return max(0, executor_pending - ASYNC_EXECUTOR_WORKERS)
+    return q.qsize() if q is not None else 0
+
+def cache_stats(attr):
+    def collect():
+        result = {}
+        for name, cache in CACHES.items():
+            if attr == "requests":
+                result[(name, "hit")] = cache.hits
+                result[(name, "miss")] = cache.misses
+            else:
+                result[(name,)] = getattr(cache, attr)
+        return result
+    return collect
+
+CACHES = {
+    "resolve": RESOLVE_CACHE,
+    "listing": CASCHE_DIRS,
+    "file_meta": FILE_META_CACHE,
+    "encoding": ENCODING_CACHE,
+    "hot_files": HOT_FILES,
+    "compressed": COMPRESSED,
+}
+REGISTRY.register(Gauge("server_active_connections",
+        "Client connections currently open", active_connections))
+REGISTRY.register(Gauge("server_queue_depth",
+        "Requests waiting for a worker thread", queue_depth))
+REGISTRY.register(Gauge("server_workers",
+        "Worker threads in the pool", lambda: {
+            ("total",): len(threads),
+            ("idle",): idle_workers},
+        ("state",)))
+REGISTRY.register(Gauge("server_cache_requests_total",
+        "Cache lookups by result", cache_stats("requests"), 
+        ("cache", "result"), typ="counter"))
+REGISTRY.register(Gauge("server_cache_entries",
+        "Entries held in cache", lambda: {(name,): len(cache) 
+                                          for name, cache in CACHES.items()},
+        ("cache",)))
+REGISTRY.register(Gauge("server_cache_bytes",
+        "Bytes held in size-bounded caches", cache_stats("nbytes"), ("cache",)))
+
+#---------------------------------
+# логирование: запись идет в фоновом потоке, рабочие потоки 
+# только кладут записи в очередь
+#---------------------------------
+log = logging.getLogger("socket_server")
+access_log = logging.getLogger("socket_server.access")
+async_log = None
+# статус и объем ответа, который сейчас отправляет этот поток
+response_state = threading.local()
+
+class AccessFormatter(logging.Formatter):
+    
+    def __init__(self, style="combined"):
+        """Строка журнала запросов: common, combined или json"""
+        super().__init__()
+        self.style = style
+    
+    def format(self, record):
+        a = record.access
+        if self.style == "json":
+            return json.dumps(a, ensure_ascii=False)
+        line = '%s - - [%s] "%s %s %s" %s %s' % (
+                    a["remote_addr"],
+                    time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(a["time"])),
+                    a["method"], a["target"], a["protocol"],
+                    a["status"] or "-",
+                    a["bytes"] or "-")
+        if self.style == "combined":
+            line += ' "%s" "%s"' % (a["referer"] or "-", a["user_agent"] or "-")
+        return line
+
+def setup_logging():
+    global async_log
+    level = getattr(logging, LOG_LEVEL)
+    handlers = []
+    
+    error_handler = BufferedFileHandler(LOG_FILE, buffer_size=LOG_BUFFER_SIZE)
+    error_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s [%(process)d %(threadName)s] %(message)s"))
+    error_handler.addFilter(lambda record: record.name != access_log.name)
+    handlers.append(error_handler)
+    
+    if ACCESS_LOG:
+        access_handler = BufferedFileHandler(
+                    None if ACCESS_LOG == "-" else ACCESS_LOG,
+                    fd=1,
+                    buffer_size=LOG_BUFFER_SIZE)
+        access_handler.setFormatter(AccessFormatter(ACCESS_LOG_FORMAT))
+        access_handler.addFilter(logging.Filter(access_log.name))
+        handlers.append(access_handler)
+        access_log.setLevel(logging.INFO)
+    else:
+        access_log.setLevel(logging.CRITICAL + 1)
+    
+    async_log = AsyncLog(handlers, 
+                         queue_size=LOG_QUEUE_SIZE, 
+                         flush_interval=LOG_FLUSH_INTERVAL)
+    log.setLevel(level)
+    log.addHandler(async_log.handler)
+    log.propagate = False
+    async_log.start()
+
+def stop_logging():
+    global async_log
+    if async_log is None:
+        return
+    log.removeHandler(async_log.handler)
+    async_log.stop()
+    for handler in async_log.handlers:
+        handler.close()
+    async_log = None
+
+def head_only():
+    # True - обрабатывается запрос HEAD: заголовки ответа те же, что у GET,
+    # но тело не отправляется, иначе клиент на постоянном соединении
+    # примет его за начало следующего ответа
+    return getattr(response_state, "head_only", False)
+
+def count_sent(size):
+    BYTES_SENT.inc(value=size)
+    response_state.bytes = getattr(response_state, "bytes", 0) + size
+
+def count_response(status):
+    RESPONSES.inc((status,))
+    response_state.status = status
+
+def log_access(request, addr, started, duration):
+    headers = dict(request.headers)
+    access_log.info("", extra={"access": {
+        "remote_addr": addr[0] if addr else "-",
+        "time": started,
+        "method": request.method,
+        "target": request.address,
+        "protocol": request.version,
+        "status": response_state.status,
+        "bytes": response_state.bytes,
+        "referer": headers.get("Referer"),
+        "user_agent": headers.get("User-Agent"),
+        "duration": round(duration, 6),
+    }})
+
+#---------------------------------
+# сжатие ответов (gzip, brotli)
+#---------------------------------
+def compress(data, coding):
+    if coding == "br":
+        return brotli.compress(data, quality=COMPRESS_LEVEL)
+    # mtime=0 - одинаковый результат для одинаковых данных
+    return gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+
+class StreamCompressor:
+    
+    def __init__(self, coding):
+        """Потоковое сжатие для ответов, отдаваемых частями"""
+        if coding == "br":
+            self.obj = brotli.Compressor(quality=COMPRESS_LEVEL)
+            self._compress = self.obj.process
+            self._flush = self.obj.finish
+        else:
+            # wbits=31 - формат gzip
+            self.obj = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+            self._compress = self.obj.compress
+            self._flush = self.obj.flush
+    
+    def compress(self, data):
+        return self._compress(data)
+    
+    def flush(self):
+        return self._flush()
+
+def negotiate_encoding(request_headers, filepath=None, meta=None, compressible=True):
+    # выбирает кодировку ответа: (кодировка, метаданные сжатой копии или None).
+    # Заранее сжатая копия рядом с файлом предпочтительнее сжатия на лету
+    if not COMPRESS or 'Range' in request_headers:
+        return None, None
+    header = request_headers.get('Accept-Encoding')
+    if not header:
+        return None, None
+    
+    codings = acceptable_encodings(header, CONTENT_CODINGS)
+    if meta is not None:
+        for coding in codings:
+            variant = find_variant(filepath, meta, coding)
+            if variant is not None:
+                return coding, variant
+    
+    size = meta.size if meta is not None else None
+    if compressible and codings and (size is None or size >= COMPRESS_MIN_SIZE):
+        return codings[0], None
+    return None, None
+
+def find_variant(filepath, meta, coding):
+    # file.gz/file.br ищется один раз на версию файла; 
+    # копия старше оригинала не используется
+    if coding not in meta.variants:
+        variant_path = filepath + CODING_SUFFIXES[coding]
         try:
-            tmp = conn.recv(65535)
-            if not tmp:   # сокет закрыли, пустой объект
-                break
-        except socket.error:
+            variant = file_meta(variant_path)
+        except OSError:
+            variant = None
+        if variant is not None and (variant.is_dir or 
+                variant.stat.st_mtime_ns < meta.stat.st_mtime_ns):
+            variant = None
+        meta.variants[coding] = variant_path if variant is not None else None
+    
+    variant_path = meta.variants[coding]
+    if variant_path is None:
+        return None
+    try:
+        return file_meta(variant_path)
+    except OSError:
+        meta.variants[coding] = None
+        return None
+
+def send_compressed_file(conn, request, filepath, meta, coding, variant,
+                         typ, charset, headers):
+    # крупные файлы сжимаются потоком, память не зависит от размера файла
+    if variant is None and meta.size > COMPRESS_CACHE_MAX_SIZE:
+        with open(filepath, "rb") as f:
+            chunks = iter(lambda: f.read(FILE_CHUNK_SIZE), b"")
+            chunked = send_chunked(conn, chunks,
+                            protocol=request.version,
+                            typ=typ,
+                            charset=charset,
+                            headers=headers,
+                            keep_alive=request.keep_alive,
+                            coding=coding)
+        request.keep_alive = request.keep_alive and chunked
+        return
+    
+    headers = headers + [("Content-Encoding", coding)]
+    # заранее сжатая копия отдается как обычный файл
+    if variant is not None:
+        with open(variant.filepath, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            send_answer(conn, 
+                        typ=typ,
+                        charset=charset,
+                        binary=True,
+                        headers=headers,
+                        keep_alive=request.keep_alive,
+                        content_length=size)
+            return send_file(conn, f, 0, size)
+    
+    # остальные сжимаются один раз на версию (ETag) и кэшируются
+    key = (meta.etag, coding)
+    data = COMPRESSED.get(key)
+    if data is None:
+        with open(filepath, "rb") as f:
+            start = time.perf_counter()
+            data = f.read()
+            observe("file_io", start)
+            data = compress(data, coding)
+        COMPRESSED.set(key, data, size=len(data))
+    send_answer(conn, 
+                typ=typ,
+                charset=charset,
+                data=data,
+                binary=True,
+                headers=headers,
+                keep_alive=request.keep_alive)
+
+#---------------------------------
+# потоковая отправка ответа частями
+#---------------------------------
+def send_chunked(conn, chunks, 
+                 protocol="HTTP/1.1",
+                 typ="text/html",
+                 charset=None,
+                 headers=None,
+                 keep_alive=False,
+                 coding=None):
+    # chunks - итератор строк или байт; первый байт уходит клиенту, как только
+    # готова первая часть. HTTP/1.0 не знает chunked - тогда отдаем 
+    # тело как есть и закрываем соединение.
+    # coding - сжимать части на лету (gzip, br)
+    encoding = charset or 'utf-8'
+    chunked = protocol == "HTTP/1.1"
+    headers = list(headers or [])
+    compressor = None
+    if coding:
+        compressor = StreamCompressor(coding)
+        headers.append(("Content-Encoding", coding))
+        chunks = itertools.chain(chunks, [None]) # None - сигнал дожать остаток
+    send_answer(conn,
+                typ=typ,
+                charset=charset,
+                binary=True,
+                headers=headers,
+                keep_alive=keep_alive and chunked,
+                chunked=True if chunked else None)
+    if head_only():
+        return chunked
+    
+    # часть отправляется, когда готова следующая: так последняя часть
+    # уходит одним sendmsg вместе с завершающим 0\r\n\r\n, а не 
+    # отдельным мелким сегментом
+    buffers = []
+    for chunk in chunks:
+        if chunk is None:
+            data = compressor.flush()
+        else:
+            data = chunk.encode(encoding) if isinstance(chunk, str) else chunk
+            if compressor is not None:
+                data = compressor.compress(data)
+        if not data:
             continue
-        except KeyboardInterrupt:
-            #(typ, val, tb) = sys.exc_info()
-            print("Route: Exit by Ctrl+C")
-            conn.close()
-            sys.exit(0)
+        if buffers:
+            send_buffers(conn, buffers)
+        if chunked:
+            # размер, данные и CRLF - одним sendmsg, без копирования части
+            buffers = [b"%x\r\n" % len(data), data, b"\r\n"]
         else:
-            data += tmp
+            buffers = [data]
     
-    return data
+    if chunked:
+        buffers.append(b"0\r\n\r\n")
+    if buffers:
+        send_buffers(conn, buffers)
+    return chunked
+
+#---------------------------------
+# отправка частей файла (206 Partial Content)
+#---------------------------------
+def send_ranges(conn, fileobj, ranges, size, 
+                typ="application/octet-stream",
+                charset=None,
+                headers=None,
+                keep_alive=False):
+    
+    headers = list(headers or [])
+    # ни один диапазон не попал в файл
+    if not ranges:
+        headers.append(("Content-Range", "bytes */%s" % size))
+        return send_answer(conn, 
+                           status="416 Range Not Satisfiable",
+                           headers=headers,
+                           keep_alive=keep_alive)
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.append(("Content-Range", "bytes %s-%s/%s" % (start, end, size)))
+        send_answer(conn, 
+                    status="206 Partial Content",
+                    typ=typ,
+                    charset=charset,
+                    binary=True,
+                    headers=headers,
+                    keep_alive=keep_alive,
+                    content_length=end - start + 1)
+        return send_file(conn, fileobj, start, end - start + 1)
+    
+    # несколько диапазонов - multipart/byteranges; 
+    # заголовки частей считаем заранее, чтобы знать Content-Length
+    boundary = hashlib.md5(os.urandom(16)).hexdigest()
+    part_type = typ + ('; charset=' + charset if charset else "")
+    parts = []
+    length = 0
+    for start, end in ranges:
+        part = ("\r\n--{}\r\n"
+                "Content-Type: {}\r\n"
+                "Content-Range: bytes {}-{}/{}\r\n\r\n").format(
+                    boundary, part_type, start, end, size).encode(DEFAULT_CHARSET)
+        parts.append((part, start, end))
+        length += len(part) + end - start + 1
+    tail = "\r\n--{}--\r\n".format(boundary).encode(DEFAULT_CHARSET)
+    length += len(tail)
+    
+    send_answer(conn, 
+                status="206 Partial Content",
+                typ="multipart/byteranges; boundary=" + boundary,
+                binary=True,
+                headers=headers,
+                keep_alive=keep_alive,
+                content_length=length)
+    if head_only():
+        return
+    # каждая часть читается с нужного смещения, остальной файл не трогаем.
+    # Небольшие части читаются в память и копятся вместе с заголовками
+    # частей, чтобы уйти одним sendmsg с концом ответа, а не мелкими
+    # сегментами; крупные идут через send_file
+    buffers = []
+    for part, start, end in parts:
+        count = end - start + 1
+        buffers.append(part)
+        if count <= FILE_CHUNK_SIZE:
+            fileobj.seek(start)
+            read_start = time.perf_counter()
+            buffers.append(fileobj.read(count))
+            observe("file_io", read_start)
+            continue
+        send_buffers(conn, buffers, MSG_MORE)
+        buffers = []
+        send_file(conn, fileobj, start, count)
+    buffers.append(tail)
+    send_buffers(conn, buffers)
+
+#---------------------------------
+# чтение данных из сокета  
+#---------------------------------
+def read_data(connection):
+    # вызывается только когда селектор сообщил о готовности сокета,
+    # поэтому recv не блокирует и не требует ожидания.
+    # Возвращает True, если заголовки запроса получены полностью,
+    # False - если нужно ждать еще данных, None - если соединение надо закрыть
+    try:
+        tmp = connection.conn.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError): # ложное пробуждение
+        return False
+    except OSError:
+        return None
+    
+    try:
+        return connection.feed(tmp)
+    except HTTPError as err:
+        # некорректный или слишком большой запрос отклоняем сразу,
+        # не занимая воркер
+        send_error(connection.conn, err)
+        return None
+
+def send_error(conn, err):
+    # готовый ответ одной неблокирующей записью: цикл событий не ждет
+    # клиента, а сброшенное клиентом соединение не роняет сервер
+    send_nowait(conn, error_answer(err.status, err.message), err.status)
 
 #---------------------------------
 # парсинг данных  
 #---------------------------------
-def parse_request(conn,data):    
-    udata = data.decode(DEFAULT_CHARSET)
+def parse_request(conn,head,keep_alive=True,addr=None,body=None):    
+    # head - заголовки, уже разобранные RequestParser, body - BodyReader
+    started = time.time()
+    start = time.perf_counter()
+    response_state.status = None
+    response_state.bytes = 0
     
-    # отделяем запрос и заголовки от данных
-    udata = udata.split("\r\n\r\n", 1)[0]
-    # разделяем запрос и заголовки на список
-    udata = udata.split('\r\n')
-    # берем первую строку содержащую запрос и делим ее на составляющие части
-    method, address, protocol = udata[0].split(" ", 2)
-    raw_headers = udata[1:] # получаем список заголовков
-    headers = []
-    for header in raw_headers:
-        name,value = header.split(":",1)
-        headers.append((name.strip(),value.strip()))
-    
-    host = dict(headers).get('Host',HOST)
-    # динамически создаем простой объект для передачи данных запроса
-    request = type("Request",(object,), {
-        "host":host,
-        'method':method,
-        'address':address,
-        'version':protocol,
-        'headers':headers
-        }
-    )
+    method, address, protocol = head.method, head.target, head.version
+    response_state.head_only = method == "HEAD"
+    headers = head.headers
+    dict_headers = dict(headers)
+    host = dict_headers.get('Host',HOST)
+    # постоянное соединение: в HTTP/1.1 по умолчанию, в HTTP/1.0 - по запросу клиента
+    connection = dict_headers.get('Connection', '').lower()
+    if protocol == "HTTP/1.1":
+        keep_alive = keep_alive and connection != "close"
+    else:
+        keep_alive = keep_alive and connection == "keep-alive"
+    # клиент ждет 100 Continue, прежде чем слать тело, - 
+    # тело нам не нужно, поэтому просто закрываем соединение после ответа
+    if body is not None and 'Expect' in dict_headers:
+        keep_alive = False
+    # о закрытии нужно решить до ответа, чтобы в нем был Connection: close:
+    # большое и chunked (неизвестной длины) тело дочитывать не будем
+    if body is not None and (head.chunked or head.content_length > BODY_DRAIN_LIMIT):
+        keep_alive = False
+    
+    request = Request(method, address, protocol, headers, host, keep_alive, body)
+    
+    observe("parse", start)
     
     debug_request_headers(request)
-    route(conn,request)
+    route_start = time.perf_counter()
+    try:
+        route(conn,request)
+    finally:
+        response_state.head_only = False
+    observe("route", route_start)
+    if LIMITER is not None and addr:
+        LIMITER.sent(addr[0], response_state.bytes)
+    # непрочитанное тело дочитываем, чтобы найти начало следующего запроса;
+    # слишком большое или битое - закрываем соединение
+    if request.keep_alive and body is not None and not body.done:
+        try:
+            request.keep_alive = body.discard(BODY_DRAIN_LIMIT)
+        except (HTTPError, OSError):
+            request.keep_alive = False
+    if access_log.isEnabledFor(logging.INFO):
+        log_access(request, addr, started, time.perf_counter() - start)
+    return request
     
 
 #---------------------------------
 # маршрутизация url и обработка соединений  
 #---------------------------------
 
+#---------------------------------
+# разрешение пути запроса
+#---------------------------------
+class Resolved:
+    __slots__ = ("path", "info", "headers")
+    
+    def __init__(self, path, info):
+        """Безопасный путь на диске и способ отдачи ресурса"""
+        self.path = path # None - путь вне ROOT
+        self.info = info
+        # заголовки для показа браузером диалога сохранения файла
+        self.headers = []
+        if path is not None and info.disposition == "attachment":
+            self.headers = [
+                ('Content-Description', 'File Transfer'),
+                ('Content-Transfer-Encoding','binary'),
+                ('Content-Disposition', 'attachment;filename=%s' % quote(
+                        os.path.basename(path)
+                        ))
+            ]
+
+def resolve(target):
+    # повторные запросы того же пути обходятся одним поиском в словаре
+    resolved = RESOLVE_CACHE.get(target)
+    if resolved is None:
+        resolved = _resolve(target)
+        RESOLVE_CACHE.set(target, resolved)
+    return resolved
+
+def _resolve(target):
+    # сначала раскодируем %XX, и только потом нормализуем путь: 
+    # иначе %2e%2e/ превращается в ../ уже после проверки
+    path = unquote(target)
+    root = os.path.normpath(ROOT)
+    filepath = os.path.normpath(os.path.join(root, path.strip('/')))
+    if "\0" in filepath or (filepath != root and 
+            not filepath.startswith(root.rstrip(os.sep) + os.sep)):
+        return Resolved(None, DEFAULT_MIME)
+    return Resolved(filepath, mime_info(filepath))
+
+#---------------------------------
+# маршрутизация
+#---------------------------------
 def route(conn,request):    
     
     charset = DEFAULT_CHARSET
     headers = []
     
-    filepath = os.path.normpath(
-                    os.path.join(ROOT,request.address.strip('/'))
-                    )
-    typ,enc = mimetypes.guess_type(filepath)
-    if typ is None:
-        typ = 'application/octet-stream'
+    if METRICS_ENABLED and request.path == METRICS_PATH:
+        return send_answer(conn, 
+                           typ="text/plain; version=0.0.4",
+                           charset="utf-8",
+                           data=REGISTRY.render(),
+                           headers=[("Cache-Control", "no-cache")],
+                           keep_alive=request.keep_alive)
     
-    filepath = unquote(filepath)
-    print('-'* 10)
-    print(filepath,typ)
+    # путь на диске, MIME тип и способ отдачи - из кэша разрешенных путей
+    resolved = resolve(request.path)
+    filepath = resolved.path
+    info = resolved.info
+    typ = info.mime
+    # один stat на запрос: существование, ETag, Last-Modified
+    # берутся из кэша метаданных; пути вне ROOT - как несуществующие
+    try:
+        meta = file_meta(filepath) if filepath is not None else None
+    except OSError:
+        meta = None
+    log.debug("%s %s", filepath, typ)
     
-    if request.address == "/":
-        answer = render_html(ROOT)
-        return send_answer(conn, 
-                            typ="text/html",
-                            charset=charset,
-                            data=answer)
+    if request.path == "/" and not request.query:
+        return route_directory(conn, request, filepath)
     else:                        
         # если запрашиваемый ресурс - директория, выводим листинг
-        if os.path.exists(filepath):
+        if meta is not None:
             # если путь - директория
-            if os.path.isdir(filepath):
-                # генерируем html для рендеринга листинга файлов
-                answer = render_html(request.address,charset=DEFAULT_CHARSET) 
-                # отправляем данные клиенту (браузеру)
-                send_answer(conn, 
-                            typ="text/html", 
-                            charset=DEFAULT_CHARSET,
-                            data=answer,
-                            headers=[("Cache-Control", "no-cache")]
-                            )
+            if meta.is_dir:
+                return route_directory(conn, request, filepath)
             # иначе - отображаем ресурс в браузере     
             else:
                 modified = True
-                headers = dict(request.headers)
+                headers = request_headers = dict(request.headers)
+                # сжатие: заранее сжатая копия рядом с файлом или сжатие на лету
+                compressible = info.compressible
+                coding,variant = negotiate_encoding(request_headers, filepath, meta,
+                                                    compressible=compressible)
+                if COMPRESS and (compressible or coding is not None):
+                    vary = [("Vary", "Accept-Encoding")]
+                else:
+                    vary = []
+                entity_tag = variant_etag(meta.etag, coding)
+                
                 if 'If-Modified-Since' in headers:
-                    if not is_modified_since(headers['If-Modified-Since'],filepath):
+                    if not is_modified_since(headers['If-Modified-Since'],filepath,meta):
                         modified = False
                         
                 if 'If-None-Match' in headers:
-                    if not is_none_match(headers['If-None-Match'],filepath):
+                    # совпадение с ETag любого варианта ресурса
+                    if headers['If-None-Match'] in (meta.etag, entity_tag):
                         modified = False 
                      
                 if 'Cache-Control' in headers:
@@ -377,55 +1754,85 @@ def route(conn,request):
                 if not modified:
                     # если ресурс не изменился - отправляем клиенту (браузеру) код 304,
                     # чтобы он взял закэшированный ресурс
-                    gmdate = time_to_rfc2616()
-                    timetuple = time_last_modified_source(filepath).timetuple()
-                    last_modified = time_to_rfc2616(timetuple)
+                    # (заголовок Date добавит send_answer)
                     headers = [
-                                ("Date", gmdate),
-                                ("ETag",etag(filepath)),
-                                ("Last-Modified",last_modified)
-                            ]
+                                ("ETag",entity_tag),
+                                ("Last-Modified",meta.last_modified)
+                            ] + vary
                     return send_answer(conn, 
                                     status="304 Not Modified",
-                                    headers=-1
+                                    headers=headers,
+                                    keep_alive=request.keep_alive
                                     )
                 
+                # небольшой файл, уже лежащий в кэше, отдаем из памяти
+                if (coding is None and 'Range' not in request_headers and 
+                        meta.size <= HOT_FILE_MAX_SIZE):
+                    hot = HOT_FILES.get(filepath)
+                    if hot is not None and hot.is_actual(meta):
+                        return send_hot_file(conn, hot, keep_alive=request.keep_alive)
+                
                 # если файл текстовый - определяем кодировку для того, 
                 # чтобы браузер мог его правильно отобразить
-                if text_types.match(typ):
-                   charset =  detect_encoding(filepath)
-                # или выводим диалог сохранения файла   
+                if info.disposition == "text":
+                   if meta.charset is None:
+                       meta.charset = detect_encoding(filepath, st=meta.stat)
+                   charset = meta.charset
+                # остальное браузер открывает сам или показывает 
+                # диалог сохранения файла (заголовки готовы в resolved)
                 else:
-                    # добавляем заголовки для показа браузером диалога сохранения файла
-                    if not browser_types.match(typ):
-                        headers = [
-                            ('Content-Description', 'File Transfer'),
-                            ('Content-Transfer-Encoding','binary'),
-                            ('Content-Disposition', 'attachment;filename=%s' % quote(
-                                    os.path.basename(filepath)
-                                    ))
-                        ]
-                        charset = None
+                    charset = None
+                headers = list(resolved.headers)
                 #------------------------------------    
-                data,size = read_file(filepath)
-                timetuple = time_last_modified_source(filepath).timetuple()
-                #print(timetuple)
-                last_modified = time_to_rfc2616(timetuple)
                 # добавляем заголовки клиентского кэширования
-                headers = []
-                headers.append(("ETag",etag(filepath)))
-                headers.append(("Last-Modified",last_modified))
+                headers.append(("ETag",entity_tag))
+                headers.append(("Last-Modified",meta.last_modified))
                 headers.append(("Cache-Control", 
                     # "max-age=%s" % MAX_AGE))
                     "max-age=%s, must-revalidate" % MAX_AGE))
                     #"max-age=%s, must-revalidate, private, no-cache" % 600)) # c no-cache не кэширует
-                send_answer(conn, 
-                            typ=typ,
-                            charset=charset,
-                            data=data,
-                            binary=True,
-                            headers=headers
-                            )
+                headers.append(("Accept-Ranges", "bytes"))
+                headers.extend(vary)
+                if coding is not None:
+                    return send_compressed_file(conn, request, filepath, meta, 
+                                                coding, variant,
+                                                typ=typ,
+                                                charset=charset,
+                                                headers=headers)
+                # тело отдаем потоком прямо из файла - 
+                # расход памяти не зависит от его размера
+                with open(filepath, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    # запрос части файла (перемотка видео, докачка);
+                    # If-Range: диапазон отдаем, только если файл не изменился
+                    ranges = None
+                    if 'Range' in request_headers:
+                        if ('If-Range' not in request_headers or 
+                                is_range_fresh(request_headers['If-Range'],filepath,meta)):
+                            ranges = parse_range(request_headers['Range'],size)
+                    
+                    if ranges is not None:
+                        return send_ranges(conn, f, ranges, size,
+                                           typ=typ,
+                                           charset=charset,
+                                           headers=headers,
+                                           keep_alive=request.keep_alive)
+                    
+                    if size <= HOT_FILE_MAX_SIZE and size == meta.size:
+                        hot = cache_hot_file(filepath, meta, f, typ, charset, headers)
+                        if hot is not None:
+                            return send_hot_file(conn, hot, keep_alive=request.keep_alive)
+                        f.seek(0)
+                    
+                    send_answer(conn, 
+                                typ=typ,
+                                charset=charset,
+                                binary=True,
+                                headers=headers,
+                                keep_alive=request.keep_alive,
+                                content_length=size
+                                )
+                    send_file(conn, f, 0, size)
         #-------------------------------------
         # если файла не существует           
         else:
@@ -441,9 +1848,59 @@ def route(conn,request):
                         typ="text/html",
                         status="404 Not Found",
                         charset=charset,
-                        data=answer) 
+                        data=answer,
+                        keep_alive=request.keep_alive) 
                         
  
+#---------------------------------
+# листинг каталога
+#---------------------------------
+def route_directory(conn, request, filepath):
+    root = request.path if request.path != "/" else ROOT
+    listing = list_directory(filepath)
+    
+    # постраничный вывод: ?offset=&limit=
+    params = parse_qs(request.query)
+    try:
+        offset = max(0, int(params.get("offset", ["0"])[0]))
+        limit = params.get("limit")
+        limit = max(1, int(limit[0])) if limit else None
+    except ValueError:
+        offset,limit = 0,None
+    
+    headers = [("Cache-Control", "no-cache")]
+    coding,_ = negotiate_encoding(dict(request.headers))
+    if COMPRESS:
+        headers.append(("Vary", "Accept-Encoding"))
+    # небольшие каталоги целиком отдаем из кэша готовых страниц
+    if not offset and limit is None and len(listing.entries) <= LISTING_STREAM_THRESHOLD:
+        # генерируем html для рендеринга листинга файлов
+        answer = render_html(root,charset=DEFAULT_CHARSET,coding=coding) 
+        if coding is not None:
+            headers.append(("Content-Encoding", coding))
+        # отправляем данные клиенту (браузеру)
+        return send_answer(conn, 
+                    typ="text/html", 
+                    charset=DEFAULT_CHARSET,
+                    data=answer,
+                    binary=coding is not None,
+                    headers=headers,
+                    keep_alive=request.keep_alive
+                    )
+    
+    # огромные каталоги и отдельные страницы листинга идут потоком
+    # по мере генерации - первый байт не ждет всей страницы
+    chunks = iter_html(root, DEFAULT_CHARSET, offset, limit, listing)
+    chunked = send_chunked(conn, chunks,
+                    protocol=request.version,
+                    typ="text/html",
+                    charset=DEFAULT_CHARSET,
+                    headers=headers,
+                    keep_alive=request.keep_alive,
+                    coding=coding)
+    # без chunked конец ответа обозначается закрытием соединения
+    request.keep_alive = request.keep_alive and chunked
+ 
 #---------------------------------
 # многопоточная обработка
 #---------------------------------  
@@ -457,162 +1914,832 @@ class Worker(threading.Thread):
      
     def run(self):
         """Запуск потока"""
+        global idle_workers
         while True:
+            with pool_lock:
+                idle_workers += 1
+            try:
+                item = self.queue.get(timeout=WORKER_IDLE_TIMEOUT)
+            except queue.Empty:
+                # простаивающий поток сверх минимума завершается
+                with pool_lock:
+                    idle_workers -= 1
+                    if len(threads) > MIN_WORKERS:
+                        threads.remove(self)
+                        break
+                continue
+            with pool_lock:
+                idle_workers -= 1
+            
             try:
-                item = self.queue.get()
                 if item is None:
                     break
-                conn, addr = item
-                #print(conn, addr)
-                self.work(conn, addr)
-            except Exception as err:
-                print(err)
-            else:
-                if conn:
-                    conn.close() 
+                keep_alive = False
+                keep_alive = self.work(item)
+            except Exception:
+                log.exception("Worker: request failed")
             finally:
+                if item is not None:
+                    if keep_alive:
+                        # соединение возвращается в цикл событий ждать новых запросов
+                        resume_connection(item)
+                    elif item.linger:
+                        item.lingering_close()
+                    else:
+                        item.close() 
                 self.queue.task_done() 
      
-    def work(self, conn, addr):
-        data = read_data(conn, addr)
-        # данные пришли - обрабатываем
-        if data:
-            parse_request(conn,data) 
+    def work(self, connection):
+        # заголовки запроса уже целиком прочитаны циклом событий,
+        # дальше отвечаем клиенту в блокирующем режиме с таймаутом.
+        # Обрабатываем все конвейерные запросы, накопившиеся в буфере,
+        # строго по очереди, чтобы ответы шли в порядке запросов
+        connection.conn.settimeout(SEND_TIMEOUT)
+        if connection.queued is not None:
+            wait = time.perf_counter() - connection.queued
+            observe("queue", connection.queued)
+            connection.queued = None
+            # запросы ждут свободного потока слишком долго - добавляем поток
+            if wait >= SCALE_UP_WAIT:
+                grow_workers()
+        while True:
+            try:
+                head = connection.next_request()
+            except HTTPError as err:
+                send_error(connection.conn, err)
+                return False
+            if head is None:
+                return True
+            # первый запрос лимит уже проверил цикл событий, 
+            # конвейерные за ним проверяются здесь
+            if connection.admitted:
+                connection.admitted = False
+            else:
+                retry = throttled(connection.addr)
+                if retry:
+                    send_refusal(connection.conn, TOO_MANY_REQUESTS, retry)
+                    return False
+            connection.requests += 1
+            body = connection.body(head, connection.conn.recv)
+            request = parse_request(connection.conn, head,
+                    keep_alive=connection.requests < MAX_KEEPALIVE_REQUESTS,
+                    addr=connection.addr,
+                    body=body) 
+            if not request.keep_alive:
+                connection.linger = body is not None and not body.done
+                return False
     
     
-def create_workers(max_workers=10):
-    global q, threads
-    q = queue.Queue()
+def create_workers(min_workers=None, queue_size=None):
+    global q, threads, pool_lock, idle_workers
+    if min_workers is None:
+        min_workers = MIN_WORKERS
+    if queue_size is None:
+        queue_size = WORKER_QUEUE_SIZE
+    q = queue.Queue(queue_size)
     threads = []
+    pool_lock = threading.Lock()
+    idle_workers = 0
     
-    for i in range(max_workers):
+    for i in range(min_workers):
+        grow_workers()
+
+def grow_workers():
+    # добавляет один поток, если пул еще не достиг MAX_WORKERS
+    with pool_lock:
+        if len(threads) >= MAX_WORKERS:
+            return False
         t = Worker(q)
-        t.start()
         threads.append(t)
+    t.start()
+    return True
 
-def stop_workers(max_workers):
+def dispatch(connection):
+    # передает соединение воркеру; False - очередь переполнена.
+    # Если свободных потоков нет, а очередь уже не пуста - 
+    # добавляем поток, не дожидаясь, пока вырастет время ожидания
+    if not idle_workers and q.qsize():
+        grow_workers()
+    connection.queued = time.perf_counter()
+    try:
+        q.put_nowait(connection)
+    except queue.Full:
+        return False
+    return True
+
+def stop_workers():
     # останавливаем воркеры
-    for _ in range(max_workers):
+    with pool_lock:
+        workers = list(threads)
+    for _ in workers:
         q.put(None)
         
-    for t in threads:
+    for t in workers:
         t.join() # дожидаемся завершения потоков
-        print('{:<10}|Closed:{}'.format(
+        log.info('{:<10}|Closed:{}'.format(
             t.name, 
             not t.is_alive())
         )
 
 #---------------------------------
-# запуск сервера
+# ответы из цикла событий
+#---------------------------------
+SERVICE_UNAVAILABLE = "503 Service Unavailable"
+TOO_MANY_REQUESTS = "429 Too Many Requests"
+REQUEST_TIMEOUT = "408 Request Timeout"
+
+def error_answer(status, message=None, headers=None):
+    # готовый короткий ответ с закрытием соединения, который можно
+    # отправить прямо из цикла событий, не занимая воркер
+    body = ((message or status.split(" ", 1)[1]) + "\n").encode(DEFAULT_CHARSET)
+    return b"".join([
+        status_line("HTTP/1.1", status),
+        ENCODED_HEADERS[SERVER_HEADER],
+        http_date_header(),
+        ENCODED_HEADERS[CONNECTION_HEADERS[False]],
+        encode_headers([
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", len(body)),
+        ] + (headers or [])),
+        b"\r\n",
+        body,
+    ])
+
+def overload_answer(status=SERVICE_UNAVAILABLE, retry_after=None):
+    # 503 (429) с Retry-After
+    if retry_after is None:
+        retry_after = RETRY_AFTER
+    return error_answer(status, headers=[("Retry-After", retry_after)])
+
+def send_nowait(conn, data, status):
+    # одна попытка send без ожидания: короткий ответ целиком помещается 
+    # в буфер отправки, а если нет (или клиент уже сбросил соединение) - 
+    # клиент просто увидит закрытое соединение, цикл событий не блокируется
+    try:
+        conn.send(data)
+        count_sent(len(data))
+    except OSError:
+        pass
+    count_response(status[:3])
+
+def send_refusal(conn, status=SERVICE_UNAVAILABLE, retry_after=None):
+    send_nowait(conn, overload_answer(status, retry_after), status)
+
+def reject_overloaded(connection, status=SERVICE_UNAVAILABLE, retry_after=None):
+    send_refusal(connection.conn, status, retry_after)
+    connection.close()
+
+#---------------------------------
+# лимиты на клиента
+#---------------------------------
+def setup_limiter():
+    global LIMITER
+    if not (CLIENT_MAX_CONNECTIONS or CLIENT_REQUEST_RATE or CLIENT_BANDWIDTH):
+        LIMITER = None
+        return
+    LIMITER = ClientLimiter(max_connections=CLIENT_MAX_CONNECTIONS,
+                            request_rate=CLIENT_REQUEST_RATE,
+                            request_burst=CLIENT_REQUEST_BURST,
+                            bandwidth=CLIENT_BANDWIDTH,
+                            bandwidth_burst=CLIENT_BANDWIDTH_BURST,
+                            shards=LIMIT_SHARDS)
+
+def admit_connection(conn, addr):
+    # True - соединение учтено в лимитах клиента (или лимитов нет);
+    # лишнее соединение получает 429 и закрывается сразу после accept
+    if LIMITER is None or LIMITER.connect(addr[0]):
+        return True
+    log.debug("Refused: %s, too many connections", addr[0])
+    send_refusal(conn, TOO_MANY_REQUESTS)
+    conn.close()
+    return False
+
+def throttled(addr):
+    # 0 - запрос клиента можно обслуживать, иначе - Retry-After в секундах
+    if LIMITER is None or not addr:
+        return 0
+    wait = LIMITER.admit(addr[0])
+    return max(1, int(math.ceil(wait))) if wait else 0
+
+#---------------------------------
+# прием входящих соединений
+#---------------------------------
+def set_nodelay(conn):
+    # ответы и так собираются в крупные записи (sendmsg, MSG_MORE),
+    # а мелкий хвост ответа (конец chunked тела, граница multipart) 
+    # алгоритм Нейгла задержал бы до отложенного ACK клиента (~40 мс)
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+ACCEPT_RESOURCE_ERRORS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM}
+
+def accept_connections(sock, sel, pending, batch=None):
+    # за одно пробуждение селектора забираем из очереди ядра 
+    # сразу пачку ожидающих соединений.
+    # False - ресурсы кончились, прием стоит отложить на ACCEPT_BACKOFF
+    if batch is None:
+        batch = ACCEPT_BATCH
+    
+    for _ in range(batch):
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, InterruptedError): # очередь пуста
+            break
+        except OSError as err:
+            # соединение в очереди ядра остается до следующей попытки
+            if err.errno in ACCEPT_RESOURCE_ERRORS:
+                log.warning("Main: accept failed: %s", err)
+                return False
+            # ECONNABORTED и прочие - клиент ушел, не дождавшись accept
+            log.debug("Main: accept failed: %s", err)
+            break
+        
+        log.debug("Connected: %s", addr[0])
+        try:
+            # включаем неблокирующий режим для recv
+            conn.setblocking(0)
+            set_nodelay(conn)
+            if not admit_connection(conn, addr):
+                continue
+            # сокет ждет данных в селекторе, а не в потоке воркера
+            connection = Connection(conn, addr, limited=LIMITER is not None)
+            sel.register(connection, selectors.EVENT_READ, connection)
+            pending[connection] = None
+            
+        # перехватываем внутренние ошибки сервера
+        except Exception as err:
+            log.exception("[Internal Error]")
+            # генерируем html для рендеринга ошибки
+            answer = render_error(
+                            charset=DEFAULT_CHARSET,
+                            title='Ой! Ошибочка вышла...',
+                            status_code=500,
+                            message='Internal Server Error',
+                            traceback=err)
+            # отправляем данные клиенту (браузеру)
+            send_answer(conn, 
+                        typ="text/html",
+                        status="500 Internal Server Error",
+                        charset=DEFAULT_CHARSET,
+                        data=answer)
+            conn.close()
+    return True
+
+#---------------------------------
+# возврат постоянных соединений в цикл событий
+#---------------------------------
+def resume_connection(connection):
+    # вызывается из потока воркера: сам селектор трогает только главный поток,
+    # поэтому кладем соединение в очередь и будим цикл через socketpair
+    resumed.append(connection)
+    try:
+        wakeup_w.send(b"\0")
+    except OSError: # буфер полон - цикл и так проснется
+        pass
+
+def register_resumed(sel, pending):
+    try:
+        while wakeup_r.recv(4096):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+    
+    while resumed:
+        connection = resumed.popleft()
+        connection.conn.setblocking(0)
+        # простаивающее соединение держим не дольше KEEPALIVE_TIMEOUT
+        connection.deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        sel.register(connection, selectors.EVENT_READ, connection)
+        pending[connection] = None
+
+#---------------------------------
+# чтение запросов готовых соединений
+#---------------------------------
+def handle_readable(connection, sel, pending):
+    # ошибка при обработке одного клиента не должна останавливать цикл
+    try:
+        read_request(connection, sel, pending)
+    except Exception:
+        log.exception("Main: failed to handle %s", connection.addr[0])
+        if connection in pending:
+            sel.unregister(connection)
+            del pending[connection]
+        connection.close()
+
+def read_request(connection, sel, pending):
+    start = time.perf_counter()
+    ready = read_data(connection)
+    observe("read", start)
+    if ready is False: # запрос пришел не целиком - ждем дальше
+        return
+    
+    sel.unregister(connection)
+    del pending[connection]
+    if ready:
+        # клиент превысил лимит запросов или трафика - 429 без воркера
+        retry = throttled(connection.addr)
+        if retry:
+            reject_overloaded(connection, TOO_MANY_REQUESTS, retry)
+            return
+        connection.admitted = True
+        # запрос получен полностью - отдаем его воркеру,
+        # а если все заняты и очередь полна - сразу отказываем
+        if not dispatch(connection):
+            reject_overloaded(connection)
+    else:
+        connection.close()
+
+def expire_connections(sel, pending):
+    # закрываем соединения, не приславшие запрос вовремя
+    now = time.monotonic()
+    expired = [c for c in pending if c.deadline <= now]
+    for connection in expired:
+        sel.unregister(connection)
+        del pending[connection]
+        # молча закрываем простаивающие постоянные соединения,
+        # а на недополученный запрос отвечаем 408
+        if connection.buffer:
+            send_nowait(connection.conn, error_answer(REQUEST_TIMEOUT), REQUEST_TIMEOUT)
+        connection.close()
+
+#---------------------------------
+# слушающий сокет
 #---------------------------------   
-def serve_forever(server,port,charset):
+def create_listen_socket(server, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        # каждый дочерний процесс слушает свой сокет на том же порту,
+        # а ядро само распределяет между ними входящие соединения
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.setblocking(0) # включаем неблокирующий режим для accept
     sock.bind((server, port))
     sock.listen(DEPTH_QUEUE_CONNECTIONS)
+    return sock
+
+#---------------------------------
+# запуск сервера
+#---------------------------------   
+def serve_forever(server,port,charset):
+    sock = create_listen_socket(server, port)
+    
+    create_workers()
+    start_crawler()
     
-    create_workers(max_workers=MAX_WORKERS)
+    global resumed, wakeup_r, wakeup_w
+    resumed = collections.deque() # постоянные соединения от воркеров
+    wakeup_r, wakeup_w = socket.socketpair()
+    wakeup_r.setblocking(0)
+    wakeup_w.setblocking(0)
+    
+    # вместо холостого цикла по accept ждем готовности сокетов 
+    # через selectors (epoll/kqueue/select - что есть в системе).
+    # Клиентские сокеты тоже ждут в селекторе, пока не придет 
+    # весь заголовок запроса, и не занимают потоки воркеров
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    sel.register(wakeup_r, selectors.EVENT_READ, wakeup_r)
+    pending = {} # соединения, ожидающие запроса
+    last_check = time.monotonic()
+    accept_paused = None # до какого момента слушающий сокет снят с селектора
     
     try:
         while 1: 
-            #time.sleep(0.01)
-            try:
-                conn, addr = sock.accept()
-                print('-' * 10)
-                print("Connected: " + addr[0])
-            
-            except socket.error: # данных нет
-               continue
-            
-            except KeyboardInterrupt:
-                print("Connected: Exit by Ctrl+C")
-                stop_workers(MAX_WORKERS)
-                
-                if conn:
-                    conn.close()
-                sys.exit(0)
+            # таймаут нужен для проверки дедлайнов чтения и для того, 
+            # чтобы Ctrl+C доходил и под Windows
+            timeout = SELECT_TIMEOUT
+            if accept_paused is not None:
+                timeout = max(0, min(timeout, accept_paused - time.monotonic()))
+            for key, mask in sel.select(timeout=timeout):
+                if key.data is None:
+                    if not accept_connections(key.fileobj, sel, pending):
+                        # иначе селектор будет будить цикл вхолостую,
+                        # пока не освободятся дескрипторы
+                        sel.unregister(sock)
+                        accept_paused = time.monotonic() + ACCEPT_BACKOFF
+                elif key.data is wakeup_r:
+                    register_resumed(sel, pending)
+                else:
+                    handle_readable(key.data, sel, pending)
             
-            else:    
-                try:
-                    # включаем неблокирующий режим для recv
-                    conn.setblocking(0)
-                    #work(conn,addr)
-                    q.put((conn,addr)) 
-                    
-                # перехватываем внутренние ошибки сервера
-                except Exception as err:
-                    trace = traceback.format_exc()
-                    print("[Internal Error]:",trace)
-                    # генерируем html для рендеринга ошибки
-                    answer = render_error(
-                                    charset=DEFAULT_CHARSET,
-                                    title='Ой! Ошибочка вышла...',
-                                    status_code=500,
-                                    message='Internal Server Error',
-                                    traceback=err)
-                    # отправляем данные клиенту (браузеру)
-                    send_answer(conn, 
-                                typ="text/html",
-                                status="500 Internal Server Error",
-                                charset=DEFAULT_CHARSET,
-                                data=answer)   
-                finally: 
-                    pass
+            now = time.monotonic()
+            if accept_paused is not None and now >= accept_paused:
+                sel.register(sock, selectors.EVENT_READ)
+                accept_paused = None
+            if now - last_check >= SELECT_TIMEOUT:
+                expire_connections(sel, pending)
+                last_check = now
                 
     except KeyboardInterrupt:
-        print("Main: Exit by Ctrl+C")        
-        stop_workers(MAX_WORKERS) 
+        log.info("Main: Exit by Ctrl+C")        
         
     finally: 
+        # воркеры - не демоны: без остановки процесс повиснет 
+        # после любой ошибки цикла
+        stop_workers() 
+        stop_crawler()
+        for connection in list(pending) + list(resumed):
+            connection.close()
+        sel.close()
+        wakeup_r.close()
+        wakeup_w.close()
         sock.close()
+    
+#--------------------------------------------------
+
 
+#---------------------------------
+# асинхронный движок (asyncio)
+#---------------------------------
+class AsyncConnection:
+    
+    def __init__(self, loop, sock):
+        """Сокет клиента для кода, работающего в потоке исполнителя.
+        
+        route и send_answer пишут в него как в обычный сокет, 
+        а сама отправка выполняется циклом событий
+        """
+        self.loop = loop
+        self.sock = sock
+    
+    def _run(self, coro):
+        future = asyncio.run_coroutine_threadsafe(
+                        asyncio.wait_for(coro, SEND_TIMEOUT), self.loop)
+        return future.result()
+    
+    def sendall(self, data):
+        # таймаут - на каждую часть: медленно, но без пауз читающий 
+        # клиент получит ответ любого размера
+        view = memoryview(data).cast("B")
+        for pos in range(0, len(view), ASYNC_SEND_WINDOW):
+            self._run(self.loop.sock_sendall(self.sock, view[pos:pos + ASYNC_SEND_WINDOW]))
+    
+    def sendfile(self, fileobj, offset=0, count=None):
+        total = 0
+        while count is None or total < count:
+            size = ASYNC_SEND_WINDOW if count is None else min(ASYNC_SEND_WINDOW, count - total)
+            sent = self._run(self.loop.sock_sendfile(self.sock, fileobj, offset + total, size))
+            if not sent: # конец файла
+                break
+            total += sent
+        return total
     
+    def recv(self, size):
+        # тело запроса читается из потока исполнителя через цикл событий
+        return self._run(self.loop.sock_recv(self.sock, size))
+
+async def read_data_async(loop, connection):
+    # то же, что read_data, но ожидание данных - в цикле событий, а не в потоке.
+    # Возвращает True, когда заголовки запроса получены полностью
+    while True:
+        timeout = connection.deadline - time.monotonic()
+        try:
+            tmp = await asyncio.wait_for(
+                        loop.sock_recv(connection.conn, RECV_SIZE), 
+                        max(timeout, 0))
+        except asyncio.TimeoutError:
+            # молча закрываем простаивающие постоянные соединения,
+            # а на недополученный запрос отвечаем 408
+            if connection.buffer:
+                send_nowait(connection.conn, error_answer(REQUEST_TIMEOUT), REQUEST_TIMEOUT)
+            return False
+        except OSError:
+            return False
+        
+        start = time.perf_counter()
+        try:
+            ready = connection.feed(tmp)
+        except HTTPError as err:
+            # некорректный или слишком большой запрос
+            send_error(connection.conn, err)
+            return False
+        finally:
+            observe("read", start)
+        if ready is None:
+            return False
+        if ready:
+            return True
+
+def submit_request(loop, func, *args):
+    # передает запрос исполнителю и считает незавершенные запросы:
+    # по этому счетчику решается, отказывать ли с 503.
+    # Счетчик меняется только в потоке цикла событий
+    global executor_pending
+    executor_pending += 1
+    future = loop.run_in_executor(executor, func, *args)
+    future.add_done_callback(request_done)
+    return future
+
+def request_done(future):
+    global executor_pending
+    executor_pending -= 1
+
+async def lingering_close_async(loop, connection):
+    # то же, что Connection.lingering_close, но ожидание - в цикле событий
+    try:
+        connection.conn.shutdown(socket.SHUT_WR)
+        deadline = time.monotonic() + LINGER_TIMEOUT
+        total = 0
+        while total < LINGER_LIMIT:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            data = await asyncio.wait_for(
+                        loop.sock_recv(connection.conn, RECV_SIZE), timeout)
+            if not data:
+                break
+            total += len(data)
+    except (OSError, asyncio.TimeoutError):
+        pass
+
+def parse_request_queued(queued, conn, head, keep_alive=True, addr=None, body=None):
+    # то же, что parse_request, плюс время ожидания свободного потока исполнителя
+    observe("queue", queued)
+    return parse_request(conn, head, keep_alive, addr, body)
+
+async def handle_client_async(loop, conn, addr):
+    connection = Connection(conn, addr, limited=LIMITER is not None)
+    writer = AsyncConnection(loop, conn)
+    try:
+        while True:
+            try:
+                head = connection.next_request()
+            except HTTPError as err:
+                send_error(conn, err)
+                break
+            if head is None:
+                # конвейерных запросов в буфере нет - ждем следующий,
+                # не занимая ни одного потока
+                if connection.requests:
+                    connection.deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+                if not await read_data_async(loop, connection):
+                    break
+                continue
+            
+            # клиент превысил лимиты или исполнитель не успевает - 
+            # отказываем, не ставя запрос в очередь
+            retry = throttled(addr)
+            if retry:
+                status = TOO_MANY_REQUESTS
+            elif queue_depth() >= WORKER_QUEUE_SIZE:
+                status = SERVICE_UNAVAILABLE
+            else:
+                status = None
+            if status is not None:
+                data = overload_answer(status, retry or None)
+                await loop.sock_sendall(conn, data)
+                count_sent(len(data))
+                count_response(status[:3])
+                break
+            
+            connection.requests += 1
+            body = connection.body(head, writer.recv)
+            # разбор запроса и маршрутизация (stat, chardet, чтение каталогов)
+            # блокируют, поэтому идут в потоке исполнителя
+            request = await submit_request(loop, parse_request_queued, 
+                        time.perf_counter(), writer, head, 
+                        connection.requests < MAX_KEEPALIVE_REQUESTS, addr,
+                        body)
+            if not request.keep_alive:
+                connection.linger = body is not None and not body.done
+                break
+    except Exception:
+        log.exception("Client: request failed")
+    finally:
+        if connection.linger:
+            await lingering_close_async(loop, connection)
+        connection.close()
+
+async def serve_async(server, port, charset):
+    global executor, executor_pending
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(ASYNC_EXECUTOR_WORKERS)
+    executor_pending = 0
+    
+    sock = create_listen_socket(server, port)
+    start_crawler()
+    
+    tasks = set()
+    try:
+        while 1:
+            try:
+                conn, addr = await loop.sock_accept(sock)
+            except OSError as err:
+                # кончились дескрипторы или клиент ушел до accept -
+                # сервер продолжает работать, а прием ненадолго откладывается
+                log.warning("Main: accept failed: %s", err)
+                await asyncio.sleep(ACCEPT_BACKOFF)
+                continue
+            log.debug("Connected: %s", addr[0])
+            conn.setblocking(0)
+            set_nodelay(conn)
+            if not admit_connection(conn, addr):
+                continue
+            task = loop.create_task(handle_client_async(loop, conn, addr))
+            # держим ссылку на задачу, пока она не завершится
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        stop_crawler()
+        for task in tasks:
+            task.cancel()
+        sock.close()
+        executor.shutdown(wait=False)
+
+def serve_forever_async(server,port,charset):
+    try:
+        asyncio.run(serve_async(server, port, charset))
+    except KeyboardInterrupt:
+        log.info("Main: Exit by Ctrl+C")
+
+
+#---------------------------------
+# многопроцессный режим (pre-fork)
+#---------------------------------
+def run_engine(server, port, charset):
+    setup_limiter()
+    load_snapshot()
+    start_watcher()
+    try:
+        if ENGINE == "asyncio":
+            serve_forever_async(server, port, charset)
+        else:
+            serve_forever(server, port, charset)
+    finally:
+        # воркеры уже остановлены (stop_workers) - кэши больше не меняются
+        save_snapshot()
+        stop_watcher()
+
+def spawn_process(server, port, charset):
+    pid = os.fork()
+    if pid:
+        return pid
+    
+    # дочерний процесс: SIGTERM от супервизора превращаем в KeyboardInterrupt,
+    # чтобы сработала обычная остановка через stop_workers
+    code = 0
+    try:
+        if async_log is not None:
+            async_log.after_fork()
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        run_engine(server, port, charset)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        log.exception("Processes: child failed")
+        code = 1
+    finally:
+        stop_logging()
+        sys.stdout.flush()
+        os._exit(code)
+
+def serve_processes(server, port, charset, processes):
+    global REUSE_PORT
+    
+    if not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        log.warning("Processes: fork/SO_REUSEPORT are not available, running one process")
+        return run_engine(server, port, charset)
+    
+    REUSE_PORT = True
+    children = {} # pid -> время запуска
+    for _ in range(processes):
+        children[spawn_process(server, port, charset)] = time.monotonic()
+    
+    # супервизор сам соединения не обслуживает: только следит за детьми
+    # и перезапускает упавших
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while 1:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            log.warning("Processes: child %s exited with status %s, restarting", pid, status)
+            # процесс, падающий сразу после старта, не перезапускаем в цикле
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            children[spawn_process(server, port, charset)] = time.monotonic()
+    
+    except KeyboardInterrupt:
+        log.info("Processes: Exit by Ctrl+C")
+        stop_processes(children)
+
+def stop_processes(children, timeout=10):
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    
+    deadline = time.monotonic() + timeout
+    while children and time.monotonic() < deadline:
+        for pid in list(children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                log.info('{:<10}|Closed:True'.format(pid))
+                del children[pid]
+        time.sleep(0.1)
+    
+    # не успевшие завершиться за timeout - убиваем
+    for pid in children:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        log.info('{:<10}|Closed:Killed'.format(pid))
+
+
 #--------------------------------------------------
-if __name__ == "__main__":
-    CASCHE_DIRS = {}
-    HOST = SERVER,PORT = "0.0.0.0",8080
-    HOST = ":".join(map(str,HOST))
-    # корневая директория, которая будет доступна по адресу http://localhost:8080
-    ROOT = os.path.dirname(__file__)
-    DEFAULT_CHARSET = "utf-8"
-    MAX_AGE = 0
-    MAX_WORKERS = 100
-    DEPTH_QUEUE_CONNECTIONS = 10
-    
-    if not mimetypes.inited:
-        mimetypes.init() 
-    
-    # добавляем и переопределяем некоторые mime типы
-    mimetypes.types_map.update(
-        {
-        ""     :'application/octet-stream', # файлам без расширения дадим дефолтный тип неизвестного двоичного содержимого 
-        ".json":"application/json", # отсутствует
-        ".vbs" :"text/plain",       # отсутствует, определяем для открытия в браузере
-        ".csv" :"text/plain",       # переопределяем для открытия в браузере
-        ".djvu":"application/djvu", # отсутствует
-        ".js"  :"text/plain",       # переопределяем для открытия в браузере
-        }
-        )
+def main(argv=None):
+    global SERVER, PORT, HOST, ROOT, ENGINE, PROCESSES
+    global LOG_LEVEL, LOG_FILE, ACCESS_LOG, ACCESS_LOG_FORMAT
+    global DEPTH_QUEUE_CONNECTIONS, MIN_WORKERS, MAX_WORKERS, WORKER_QUEUE_SIZE
+    global FS_WATCH, SNAPSHOT_FILE, CRAWL, CRAWL_DEPTH, CRAWL_RATE
+    global CLIENT_MAX_CONNECTIONS, CLIENT_REQUEST_RATE, CLIENT_REQUEST_BURST
+    global CLIENT_BANDWIDTH, CLIENT_BANDWIDTH_BURST
     
-    # типы, которые нужно открывать текстовом режиме и декодировать
-    text_types = re.compile("|".join(
-        ["text/.*","application/json"]
-        ))
-    
-    # типы, которые мы хотим, чтобы браузер открывал сам
-    # любые текстовые файлы, картинки, видео (если,получится)
-    browser_types = re.compile("|".join(
-        [
-        "application/json",
-        "application/pdf",
-        "image/.*",
-        "video/.*"
-        ]
-        ))
+    parser = argparse.ArgumentParser(description="Сокет сервер для листинга директорий")
+    parser.add_argument("--host", default=SERVER, help="адрес для прослушивания")
+    parser.add_argument("--port", type=int, default=PORT, help="порт")
+    parser.add_argument("--root", default=ROOT, help="корневая директория")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default=ENGINE,
+                        help="пул потоков или цикл событий asyncio")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="число процессов, слушающих порт через SO_REUSEPORT")
+    parser.add_argument("--backlog", type=int, default=DEPTH_QUEUE_CONNECTIONS,
+                        help="длина очереди listen")
+    parser.add_argument("--min-workers", type=int, default=MIN_WORKERS,
+                        help="минимальное число потоков-воркеров")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS,
+                        help="максимальное число потоков-воркеров")
+    parser.add_argument("--queue-size", type=int, default=WORKER_QUEUE_SIZE,
+                        help="длина очереди к воркерам, сверх нее - 503")
+    parser.add_argument("--client-connections", type=int, default=CLIENT_MAX_CONNECTIONS,
+                        help="одновременных соединений с одного адреса, 0 - без ограничения")
+    parser.add_argument("--client-rate", type=float, default=CLIENT_REQUEST_RATE,
+                        help="запросов в секунду с одного адреса, 0 - без ограничения")
+    parser.add_argument("--client-burst", type=float, default=CLIENT_REQUEST_BURST,
+                        help="запросов подряд сверх --client-rate")
+    parser.add_argument("--client-bandwidth", type=int, default=CLIENT_BANDWIDTH,
+                        help="байт ответов в секунду на адрес, 0 - без ограничения")
+    parser.add_argument("--client-bandwidth-burst", type=int, default=CLIENT_BANDWIDTH_BURST,
+                        help="байт подряд сверх --client-bandwidth")
+    parser.add_argument("--fs-watch", choices=("auto", "inotify", "poll", "off"), 
+                        default=FS_WATCH,
+                        help="наблюдение за изменениями файлов для сброса кэшей; "
+                             "auto - только inotify, опрос - явно через poll")
+    parser.add_argument("--snapshot", default=SNAPSHOT_FILE,
+                        help="файл снимка кэшей для быстрого старта после перезапуска")
+    parser.add_argument("--crawl", action="store_true", default=CRAWL,
+                        help="прогревать кэши фоновым обходом ROOT")
+    parser.add_argument("--crawl-depth", type=int, default=CRAWL_DEPTH,
+                        help="глубина фонового обхода")
+    parser.add_argument("--crawl-rate", type=float, default=CRAWL_RATE,
+                        help="обращений к диску в секунду при фоновом обходе")
+    parser.add_argument("--log-level", default=LOG_LEVEL,
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="уровень сообщений сервера; DEBUG - с заголовками запросов")
+    parser.add_argument("--log-file", default=LOG_FILE, 
+                        help="файл сообщений сервера (по умолчанию stderr)")
+    parser.add_argument("--access-log", default=ACCESS_LOG,
+                        help="файл журнала запросов, '-' - stdout, 'off' - не вести")
+    parser.add_argument("--access-log-format", default=ACCESS_LOG_FORMAT,
+                        choices=("common", "combined", "json"),
+                        help="формат журнала запросов")
+    args = parser.parse_args(argv)
     
-    # xlsx:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet
-    # exe: application/x-msdownload
-    print('START LISTEN SERVER:{}'.format(HOST))
-    serve_forever(SERVER,PORT,DEFAULT_CHARSET)
- 
+    LOG_LEVEL, LOG_FILE, ACCESS_LOG_FORMAT = args.log_level, args.log_file, args.access_log_format
+    ACCESS_LOG = None if args.access_log == "off" else args.access_log
+    SERVER, PORT, ENGINE = args.host, args.port, args.engine
+    ROOT = os.path.abspath(args.root)
+    PROCESSES = max(1, args.processes)
+    DEPTH_QUEUE_CONNECTIONS = args.backlog
+    MAX_WORKERS = max(1, args.max_workers)
+    MIN_WORKERS = min(max(1, args.min_workers), MAX_WORKERS)
+    WORKER_QUEUE_SIZE = max(1, args.queue_size)
+    FS_WATCH = args.fs_watch
+    CLIENT_MAX_CONNECTIONS = max(0, args.client_connections)
+    CLIENT_REQUEST_RATE, CLIENT_REQUEST_BURST = max(0, args.client_rate), max(0, args.client_burst)
+    CLIENT_BANDWIDTH, CLIENT_BANDWIDTH_BURST = max(0, args.client_bandwidth), max(0, args.client_bandwidth_burst)
+    SNAPSHOT_FILE = args.snapshot and os.path.abspath(args.snapshot)
+    CRAWL, CRAWL_DEPTH, CRAWL_RATE = args.crawl, max(0, args.crawl_depth), max(1, args.crawl_rate)
+    HOST = "{}:{}".format(SERVER, PORT)
+    
+    setup_logging()
+    log.info('START LISTEN SERVER:{}'.format(HOST))
+    try:
+        if PROCESSES > 1:
+            serve_processes(SERVER,PORT,DEFAULT_CHARSET,PROCESSES)
+        else:
+            # SIGTERM при деплое - такая же штатная остановка, как Ctrl+C:
+            # воркеры завершаются, снимок кэшей записывается
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            run_engine(SERVER,PORT,DEFAULT_CHARSET)
+    finally:
+        stop_logging()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import pytest
+
+from httpparser import (RequestParser, BodyReader, HTTPError,
+                        BAD_REQUEST, PAYLOAD_TOO_LARGE, URI_TOO_LONG,
+                        HEADERS_TOO_LARGE, NOT_IMPLEMENTED, VERSION_NOT_SUPPORTED)
+
+
+def parse(data, **limits):
+    buffer = bytearray(data)
+    return RequestParser(**limits).parse(buffer), buffer
+
+def status_of(data, **limits):
+    with pytest.raises(HTTPError) as info:
+        parse(data, **limits)
+    return info.value.status
+
+def body_reader(data, recv_data=b""):
+    buffer = bytearray(data)
+    head = RequestParser().parse(buffer)
+    chunks = [recv_data]
+    recv = lambda size: chunks.pop(0) if chunks else b""
+    return BodyReader(buffer, recv, head, max_body_size=1024), buffer
+
+
+#---------------------------------
+# заголовки
+#---------------------------------
+def test_parse_complete_request():
+    head, buffer = parse(b"GET /a?b=1 HTTP/1.1\r\nHost: x\r\nx-custom:  v \r\n\r\nNEXT")
+    assert (head.method, head.target, head.version) == ("GET", "/a?b=1", "HTTP/1.1")
+    assert head.headers == [("Host", "x"), ("X-Custom", "v")]
+    assert not head.has_body
+    # конвейерный запрос остается в буфере
+    assert buffer == b"NEXT"
+
+def test_parse_incremental():
+    parser = RequestParser()
+    buffer = bytearray()
+    for part in (b"GET / HT", b"TP/1.1\r\nHo", b"st: x\r\n", b"\r\n"):
+        buffer += part
+        head = parser.parse(buffer)
+    assert head is not None and head.headers == [("Host", "x")]
+
+def test_leading_empty_lines_and_bare_lf():
+    head, _ = parse(b"\r\n\nGET / HTTP/1.0\nHost: x\n\n")
+    assert head.version == "HTTP/1.0"
+
+@pytest.mark.parametrize("data", [
+    b"GET /\r\n\r\n",
+    b"GET  / HTTP/1.1\r\n\r\n",
+    b"G(T / HTTP/1.1\r\n\r\n",
+    b"GET / HTTP/1\r\n\r\n",
+    b"GET / HTTP/1.1\r\nHost : x\r\n\r\n",
+    b"GET / HTTP/1.1\r\nHost: x\r\n folded\r\n\r\n",
+    b"GET / HTTP/1.1\r\nNoColon\r\n\r\n",
+])
+def test_malformed(data):
+    assert status_of(data) == BAD_REQUEST
+
+def test_unsupported_version():
+    assert status_of(b"GET / HTTP/2.0\r\n\r\n") == VERSION_NOT_SUPPORTED
+
+def test_request_line_limit():
+    line = b"GET /" + b"a" * 100 + b" HTTP/1.1"
+    assert status_of(line + b"\r\n\r\n", max_request_line=64) == URI_TOO_LONG
+    # и до того, как строка закончилась
+    assert status_of(line, max_request_line=64) == URI_TOO_LONG
+
+def test_header_limits():
+    headers = b"".join(b"H%d: v\r\n" % i for i in range(10))
+    request = b"GET / HTTP/1.1\r\n" + headers + b"\r\n"
+    assert status_of(request, max_headers=5) == HEADERS_TOO_LARGE
+    assert status_of(request, max_header_size=64) == HEADERS_TOO_LARGE
+    assert status_of(b"GET / HTTP/1.1\r\nH: " + b"v" * 100, 
+                     max_header_size=64) == HEADERS_TOO_LARGE
+
+#---------------------------------
+# длина тела
+#---------------------------------
+def test_content_length():
+    head, _ = parse(b"POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n")
+    assert head.content_length == 5 and not head.chunked
+
+@pytest.mark.parametrize("headers,status", [
+    (b"Content-Length: 5\r\nContent-Length: 6\r\n", BAD_REQUEST),
+    (b"Content-Length: +5\r\n", BAD_REQUEST),
+    (b"Content-Length: 5\r\nTransfer-Encoding: chunked\r\n", BAD_REQUEST),
+    (b"Transfer-Encoding: gzip, chunked\r\n", NOT_IMPLEMENTED),
+    (b"Transfer-Encoding: chunked\r\nTransfer-Encoding: chunked\r\n", NOT_IMPLEMENTED),
+    (b"Content-Length: 2048\r\n", PAYLOAD_TOO_LARGE),
+])
+def test_body_framing(headers, status):
+    request = b"POST / HTTP/1.1\r\n" + headers + b"\r\n"
+    assert status_of(request, max_body_size=1024) == status
+
+#---------------------------------
+# тело запроса
+#---------------------------------
+def test_content_length_body_keeps_pipelined_request():
+    reader, buffer = body_reader(
+        b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nhello", b"worldGET")
+    assert b"".join(reader) == b"helloworld"
+    assert reader.done and buffer == b"GET"
+
+def test_chunked_body():
+    reader, buffer = body_reader(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"5;ext=1\r\nhello\r\nA\r\n0123456789\r\n0\r\nTrailer: x\r\n\r\nNEXT")
+    assert b"".join(reader) == b"hello0123456789"
+    assert buffer == b"NEXT"
+
+@pytest.mark.parametrize("size", [b"0x5", b"+5", b"0_5", b"-5", b" 5", b"", 
+                                  b"1" * 17])
+def test_chunk_size_is_strict_hex(size):
+    reader, _ = body_reader(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" 
+        + size + b"\r\nhello\r\n0\r\n\r\n")
+    with pytest.raises(HTTPError) as info:
+        reader.read()
+    assert info.value.status == BAD_REQUEST
+
+def test_chunk_without_crlf():
+    reader, _ = body_reader(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhelloXX0\r\n\r\n")
+    with pytest.raises(HTTPError):
+        b"".join(reader)
+
+def test_chunked_body_limit():
+    reader, _ = body_reader(
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"800\r\n" + b"x" * 2048 + b"\r\n0\r\n\r\n")
+    with pytest.raises(HTTPError) as info:
+        b"".join(reader)
+    assert info.value.status == PAYLOAD_TOO_LARGE
+
+def test_truncated_body():
+    reader, _ = body_reader(b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nhello")
+    with pytest.raises(HTTPError):
+        b"".join(reader)
+
+def test_discard():
+    reader, buffer = body_reader(
+        b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123456789GET")
+    assert reader.discard(16) and buffer == b"GET"
+    reader, _ = body_reader(
+        b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123456789")
+    assert not reader.discard(4)
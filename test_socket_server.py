@@ -0,0 +1,155 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import socket_server
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    server.setblocking(0)
+    yield server, client
+    server.close()
+    client.close()
+
+def read_slowly(sock, total, piece=65536, pause=0.01):
+    # клиент читает без пауз дольше SEND_TIMEOUT, но понемногу
+    received = bytearray()
+    def run():
+        while len(received) < total:
+            data = sock.recv(piece)
+            if not data:
+                break
+            received.extend(data)
+            time.sleep(pause)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, received
+
+
+#---------------------------------
+# SEND_TIMEOUT в движке asyncio - таймаут простоя, а не всей отправки
+#---------------------------------
+def test_async_sendall_outlives_send_timeout(monkeypatch, loop, pair):
+    monkeypatch.setattr(socket_server, "SEND_TIMEOUT", 0.3)
+    monkeypatch.setattr(socket_server, "ASYNC_SEND_WINDOW", 65536)
+    server, client = pair
+    data = bytes(range(256)) * 16384 # 4 МБ - около 0.6 с по 64 КБ за 10 мс
+    thread, received = read_slowly(client, len(data))
+    started = time.monotonic()
+    socket_server.AsyncConnection(loop, server).sendall(data)
+    thread.join()
+    assert time.monotonic() - started > 0.3
+    assert received == data
+
+def test_async_sendfile_outlives_send_timeout(monkeypatch, loop, pair, tmp_path):
+    monkeypatch.setattr(socket_server, "SEND_TIMEOUT", 0.3)
+    monkeypatch.setattr(socket_server, "ASYNC_SEND_WINDOW", 65536)
+    server, client = pair
+    data = bytes(range(256)) * 16384
+    path = tmp_path / "big.bin"
+    path.write_bytes(data)
+    thread, received = read_slowly(client, len(data) - 1000)
+    started = time.monotonic()
+    with open(path, "rb") as f:
+        sent = socket_server.AsyncConnection(loop, server).sendfile(f, 1000)
+    thread.join()
+    assert time.monotonic() - started > 0.3
+    assert sent == len(data) - 1000
+    assert received == data[1000:]
+
+def test_async_send_times_out_when_client_stalls(monkeypatch, loop, pair):
+    monkeypatch.setattr(socket_server, "SEND_TIMEOUT", 0.3)
+    server, client = pair
+    with pytest.raises(asyncio.TimeoutError):
+        socket_server.AsyncConnection(loop, server).sendall(b"x" * 16*1024*1024)
+
+
+#---------------------------------
+# очередь к исполнителю движка asyncio
+#---------------------------------
+def test_executor_queue_depth(monkeypatch, loop):
+    monkeypatch.setattr(socket_server, "ENGINE", "asyncio")
+    monkeypatch.setattr(socket_server, "ASYNC_EXECUTOR_WORKERS", 2)
+    monkeypatch.setattr(socket_server, "executor_pending", 0)
+    executor = socket_server.concurrent.futures.ThreadPoolExecutor(2)
+    monkeypatch.setattr(socket_server, "executor", executor)
+    release = threading.Event()
+    
+    async def submit(n):
+        return [socket_server.submit_request(loop, release.wait) for _ in range(n)]
+    
+    futures = asyncio.run_coroutine_threadsafe(submit(5), loop).result()
+    # два запроса выполняются, три ждут свободного потока
+    assert socket_server.executor_pending == 5
+    assert socket_server.queue_depth() == 3
+    release.set()
+    asyncio.run_coroutine_threadsafe(asyncio.wait(futures), loop).result(5)
+    assert socket_server.executor_pending == 0
+    assert socket_server.queue_depth() == 0
+    executor.shutdown()
+
+
+#---------------------------------
+# тело запроса, которое сервер не дочитывает
+#---------------------------------
+def test_unread_body_closes_gracefully(monkeypatch, tmp_path):
+    (tmp_path / "post.txt").write_bytes(b"x" * 2400)
+    monkeypatch.setattr(socket_server, "ROOT", str(tmp_path))
+    socket_server.RESOLVE_CACHE.clear()
+    
+    listener = socket.create_server(("127.0.0.1", 0))
+    client = socket.create_connection(listener.getsockname(), timeout=5)
+    conn, addr = listener.accept()
+    listener.close()
+    
+    # тело больше BODY_DRAIN_LIMIT: ответ должен дойти целиком 
+    # с Connection: close, а не потеряться из-за RST, пока клиент
+    # еще досылает тело
+    size = socket_server.BODY_DRAIN_LIMIT * 4
+    response = bytearray()
+    def run():
+        try:
+            client.sendall(b"POST /post.txt HTTP/1.1\r\nHost: x\r\n"
+                           b"Content-Length: %d\r\n\r\n" % size)
+            for _ in range(0, size, 16384):
+                client.sendall(b"z" * 16384)
+                time.sleep(0.002)
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                response.extend(data)
+        except OSError:
+            pass
+        client.close()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    
+    connection = socket_server.Connection(conn, addr)
+    while not connection.feed(conn.recv(socket_server.RECV_SIZE)):
+        pass
+    worker = socket_server.Worker(None)
+    assert worker.work(connection) is False
+    assert connection.linger
+    connection.lingering_close()
+    thread.join(5)
+    
+    head, _, body = bytes(response).partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200 OK")
+    assert b"Connection: close" in head.split(b"\r\n")
+    assert body == b"x" * 2400
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from webutils import parse_range, is_modified_since, get_file_meta
+
+
+#---------------------------------
+# заголовок Range
+#---------------------------------
+@pytest.mark.parametrize("header,expected", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=100-", [(100, 999)]),          # до конца файла
+    ("bytes=-100", [(900, 999)]),          # последние 100 байт
+    ("bytes=-5000", [(0, 999)]),           # суффикс длиннее файла
+    ("bytes=500-5000", [(500, 999)]),      # конец обрезается по размеру
+    ("Bytes = 0-0 , 10-19", [(0, 0), (10, 19)]),
+    ("bytes=50-59,0-9", [(0, 9), (50, 59)]),   # сортировка
+    ("bytes=0-50,40-99", [(0, 99)]),           # пересекающиеся
+    ("bytes=0-9,10-19", [(0, 19)]),            # смежные
+    ("bytes=0-9,-10", [(0, 9), (990, 999)]),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize("header", [
+    "bytes=1000-",
+    "bytes=1000-2000,5000-",
+    "bytes=-0",
+])
+def test_parse_range_unsatisfiable(header):
+    # ни один диапазон не попал в файл - 416
+    assert parse_range(header, 1000) == []
+
+@pytest.mark.parametrize("header", [
+    "bytes=x-5",
+    "bytes=5-x",
+    "bytes=-",
+    "bytes=5",
+    "bytes=",
+    "bytes=+5-10",
+    "bytes=0x1-5",
+    "bytes=²-5",
+    "bytes=10-5",
+    "items=0-5",
+    "garbage",
+])
+def test_parse_range_garbage(header):
+    # некорректный заголовок игнорируется - 200 с полным телом
+    assert parse_range(header, 1000) is None
+
+def test_parse_range_too_many():
+    header = "bytes=" + ",".join("%d-%d" % (i * 10, i * 10) for i in range(20))
+    assert parse_range(header, 1000, max_ranges=16) is None
+
+
+#---------------------------------
+# заголовок If-Modified-Since
+#---------------------------------
+def test_is_modified_since(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("x")
+    os.utime(path, (784111777, 784111777)) # Sun, 06 Nov 1994 08:49:37 GMT
+    meta = get_file_meta(str(path))
+    assert not is_modified_since("Sun, 06 Nov 1994 08:49:37 GMT", str(path), meta)
+    assert is_modified_since("Sun, 06 Nov 1994 08:49:36 GMT", str(path), meta)
+    assert not is_modified_since("Sun, 06 Nov 1994 08:49:37 GMT", str(path))
+
+@pytest.mark.parametrize("header", [
+    "garbage",
+    "",
+    "Sun, 06 Nov 1994 08:49:37",
+    "Sun, 32 Nov 1994 08:49:37 GMT",
+])
+def test_is_modified_since_malformed(tmp_path, header):
+    # некорректная дата - как будто заголовка нет: отдается полный ответ
+    path = tmp_path / "a.txt"
+    path.write_text("x")
+    assert is_modified_since(header, str(path), get_file_meta(str(path)))
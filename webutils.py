@@ -14,12 +14,77 @@ __version__ = '1.0.0.0'
 __date__    = '24.10.2017'
 
 import os
+import stat
 import hashlib
 import re
 import time
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 
+#--------------------------------------
+# потокобезопасный LRU кэш ограниченного размера
+#--------------------------------------
+class LRUCache:
+    
+    def __init__(self, maxsize=1024, maxbytes=None):
+        """maxsize - максимальное число записей, maxbytes - суммарный объем"""
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.sizes = {} # объем записей, если задан maxbytes
+        self.nbytes = 0
+        self.hits = 0   # статистика обращений для метрик
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            return value
+    
+    def set(self, key, value, size=0):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.nbytes += size - self.sizes.pop(key, 0)
+            if size:
+                self.sizes[key] = size
+            # вытесняем давно не использовавшиеся записи
+            while self.data and (len(self.data) > self.maxsize or 
+                    self.maxbytes is not None and self.nbytes > self.maxbytes):
+                old,_ = self.data.popitem(last=False)
+                self.nbytes -= self.sizes.pop(old, 0)
+    
+    def pop(self, key, default=None):
+        with self.lock:
+            self.nbytes -= self.sizes.pop(key, 0)
+            return self.data.pop(key, default)
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+    
+    def items(self):
+        # копия записей от давно не использовавшихся к свежим
+        with self.lock:
+            return list(self.data.items())
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, key):
+        return key in self.data
+
 #---------------------------------
 # форматирвание времени в web формат
 #---------------------------------
@@ -30,6 +95,28 @@ def time_to_rfc2616(timetuple=None):
 
 def time_to_http_format(timetuple=None):
     return time_to_rfc2616(timetuple)
+
+#---------------------------------
+# текущая дата для заголовка Date, пересчитывается раз в секунду
+#---------------------------------
+_date_cache = (0, "", b"")
+
+def http_date():
+    return _current_date()[1]
+
+def http_date_header():
+    # готовая строка заголовка b"Date: ...\r\n"
+    return _current_date()[2]
+
+def _current_date():
+    global _date_cache
+    now = int(time.time())
+    cached = _date_cache
+    if cached[0] != now:
+        date = time_to_rfc2616(time.gmtime(now))
+        # кортеж заменяется целиком, поэтому блокировка не нужна
+        cached = _date_cache = (now, date, ("Date: %s\r\n" % date).encode())
+    return cached
 #---------------------------------
 # время последней модификации файла 
 #---------------------------------
@@ -45,10 +132,16 @@ def time_last_modified_source(filepath,utc=True):
 #---------------------------------
 # валидация If-Modified-Since
 #---------------------------------
-def is_modified_since(header_if_modified_since,filepath):
-    modified_since = datetime.strptime(
-                header_if_modified_since,
-                "%a, %d %b %Y %H:%M:%S GMT")
+def is_modified_since(header_if_modified_since,filepath,meta=None):
+    # некорректную дату считаем отсутствующим заголовком (RFC 7232, 3.3)
+    try:
+        modified_since = datetime.strptime(
+                    header_if_modified_since,
+                    "%a, %d %b %Y %H:%M:%S GMT")
+    except (TypeError, ValueError, OverflowError):
+        return True
+    if meta is not None:
+        return meta.last_modified_dt > modified_since
     return time_last_modified_source(filepath) > modified_since
 
 #---------------------------------
@@ -61,9 +154,120 @@ def is_not_modified_since(header_if_modified_since,filepath):
 #---------------------------------
 # валидация If-None-Match
 #---------------------------------
-def is_none_match(header_if_none_match,filepath):
+def is_none_match(header_if_none_match,filepath,meta=None):
+    if meta is not None:
+        return header_if_none_match != meta.etag
     return header_if_none_match != etag(filepath)
 
+#---------------------------------
+# валидация If-Range
+#---------------------------------
+def is_range_fresh(header_if_range,filepath,meta=None):
+    # If-Range содержит либо ETag, либо дату последнего изменения;
+    # слабые ETag (W/"...") для диапазонов не годятся
+    value = header_if_range.strip()
+    if value.startswith('W/'):
+        return False
+    if value.startswith('"'):
+        return value == (meta.etag if meta is not None else etag(filepath))
+    try:
+        modified_since = datetime.strptime(
+                    value,
+                    "%a, %d %b %Y %H:%M:%S GMT")
+    except ValueError:
+        return False
+    if meta is not None:
+        return meta.last_modified_dt == modified_since
+    return time_last_modified_source(filepath) == modified_since
+
+#---------------------------------
+# парсинг заголовка Range
+#---------------------------------
+DIGITS = re.compile(r"[0-9]+\Z")
+
+def parse_range(header_range,size,max_ranges=16):
+    # возвращает отсортированный список диапазонов [(start,end),...] 
+    # с включительными границами, пустой список, если ни один диапазон 
+    # не попадает в файл (ответ 416), или None, если заголовок 
+    # некорректен и его нужно игнорировать (ответ 200 с полным телом)
+    unit,_,ranges_spec = header_range.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+    
+    ranges = []
+    for spec in ranges_spec.split(','):
+        start,dash,end = spec.strip().partition('-')
+        start,end = start.strip(),end.strip()
+        # каждая непустая граница - только цифры ASCII (isdigit пропустил бы
+        # и "²", на котором упадет int), и хотя бы одна граница задана
+        if (not dash or not (start or end) or 
+                start and not DIGITS.match(start) or end and not DIGITS.match(end)):
+            return None
+        if not start:   # суффикс: последние N байт
+            length = int(end)
+            if length == 0:
+                continue
+            start,end = max(0,size - length),size - 1
+        else:
+            start = int(start)
+            if start >= size:
+                continue
+            end = min(int(end),size - 1) if end else size - 1
+            if end < start:
+                return None
+        ranges.append((start,end))
+    
+    if len(ranges) > max_ranges:
+        return None
+    
+    # объединяем пересекающиеся и смежные диапазоны
+    merged = []
+    for start,end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0],max(end,merged[-1][1]))
+        else:
+            merged.append((start,end))
+    return merged
+
+#---------------------------------
+# разбор заголовка Accept-Encoding
+#---------------------------------
+def parse_accept_encoding(header_accept_encoding):
+    # {кодировка: q}
+    result = {}
+    for item in header_accept_encoding.split(','):
+        coding,_,params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name,_,value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[coding] = q
+    return result
+
+def acceptable_encodings(header_accept_encoding,supported):
+    # кодировки из supported (в порядке предпочтения сервера), 
+    # которые принимает клиент, от наиболее желательной для него
+    accepted = parse_accept_encoding(header_accept_encoding)
+    default = accepted.get('*', 0)
+    weighted = [(accepted.get(coding, default),i,coding) 
+                    for i,coding in enumerate(supported)]
+    return [coding for q,i,coding in sorted(weighted, key=lambda t: (-t[0],t[1])) if q > 0]
+
+#---------------------------------
+# ETag сжатого варианта ресурса
+#---------------------------------
+def variant_etag(etag_value,coding):
+    if not coding:
+        return etag_value
+    return etag_value[:-1] + '-' + coding + '"'
+
 #-------------------------------------- 
 # получение параметров http заголовков
 #--------------------------------------
@@ -105,11 +309,63 @@ def md5sum2(fname):
 #---------------------------------
 # генерация значения ETag
 #---------------------------------
-def etag(filepath):
-    result = str(os.stat(filepath).st_mtime) + filepath
+def etag(filepath,mtime=None):
+    if mtime is None:
+        mtime = os.stat(filepath).st_mtime
+    result = str(mtime) + filepath
     m = hashlib.md5()
     m.update(bytes(result,encoding='utf-8'))
     return '"' + m.hexdigest() + '"'
+
+#---------------------------------
+# кэш метаданных файлов
+#---------------------------------
+class FileMeta:
+    
+    def __init__(self, filepath, st):
+        """Все, что нужно для заголовков ответа, считается один раз на версию файла"""
+        self.filepath = filepath
+        self.stat = st
+        self.is_dir = stat.S_ISDIR(st.st_mode)
+        self.size = st.st_size
+        self.etag = etag(filepath, st.st_mtime)
+        dt = datetime.utcfromtimestamp(st.st_mtime)
+        self.last_modified_dt = datetime(dt.year, dt.month, dt.day, 
+                                         dt.hour, dt.minute, dt.second,0)
+        self.last_modified = time_to_rfc2616(self.last_modified_dt.timetuple())
+        self.charset = None # определяется при первой отдаче текстового файла
+        # заранее сжатые копии рядом с файлом (file.gz, file.br): 
+        # кодировка -> путь или None, ищутся один раз на версию файла
+        self.variants = {}
+        self.checked = time.monotonic() # время последней сверки с диском
+        # поколение каталога в наблюдателе за файловой системой, 
+        # при котором метаданные были сверены с диском
+        self.generation = None
+    
+    def is_actual(self, st):
+        return (self.stat.st_mtime_ns == st.st_mtime_ns and 
+                self.stat.st_size == st.st_size and 
+                self.stat.st_ino == st.st_ino)
+
+FILE_META_CACHE = LRUCache(maxsize=4096)
+
+def get_file_meta(filepath,ttl=0):
+    # метаданные сверяются с диском одним вызовом stat, 
+    # а при ttl > 0 - не чаще раза в ttl секунд.
+    # Если файла нет - выбрасывается OSError
+    meta = FILE_META_CACHE.get(filepath)
+    now = time.monotonic()
+    if meta is not None and ttl and now - meta.checked < ttl:
+        return meta
+    
+    st = os.stat(filepath)
+    if meta is not None and meta.is_actual(st):
+        meta.checked = now
+        return meta
+    
+    meta = FileMeta(filepath, st)
+    FILE_META_CACHE.set(filepath, meta)
+    return meta
     
 #--------------------------------------    
 # парсинг аргумента date в формате 1w1d1h1m1s